@@ -1,7 +1,7 @@
 # region Imports
 
 from pathlib import Path
-import sys, argparse,subprocess,shlex
+import sys, os, argparse,subprocess,shutil
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -9,7 +9,10 @@ root_dir = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(root_dir))
 
 from src.config_loader import ConfigLoader
-from src.utils import log_subprocess, get_max_threads, get_total_memory
+from src.utils import log_subprocess, get_total_memory, R1_RE
+
+# resolve sbatch once at import so each submission skips the PATH search
+sbatch_bin = shutil.which("sbatch") or "sbatch"
 
 # endregion
 
@@ -62,47 +65,120 @@ def launcher():
 
     # get run name and handle run dir
     name = str(cfg.get("project","name"))
-    jobname = shlex.quote(name)
     project_dir =  cfg.get_path("project","name",base_path=args.root)
     project_dir.mkdir(parents=True,exist_ok=True)
 
-    # count samples
-    r1_files = sorted(Path(args.indir).glob("*_R1*.fastq*"))
-    num_samples = len(r1_files)
+    # count samples, scandir reuses the readdir stat info instead of re-statting every entry like glob
+    # shared precompiled regex keeps this in sync with generate_paired_samples
+    with os.scandir(args.indir) as it:
+        num_samples = sum(
+            1 for e in it
+            if e.is_file(follow_symlinks=False) and R1_RE.search(e.name)
+        )
     if num_samples == 0:
         raise FileNotFoundError(f"No R1 fastq files found in {args.indir}")
 
     # get cfg values
-    max_threads = get_max_threads(cfg)
-    total_mem = get_total_memory(cfg,max_threads)
     conda_env = cfg.get("project","conda_env")
 
     # run script path
-    run_script_path = shlex.quote(str(Path(args.root) / args.runScript))
+    run_script_path = str(Path(args.root) / args.runScript)
 
-    # get steps
-    steps = shlex.quote(' '.join(args.steps))
+    # ---------------------------------------------------
+    # build per-step resource requests
+    # ---------------------------------------------------
+
+    # one big job sized for STAR wastes cpus/memory during the cheap trim and count stages,
+    # so steps are submitted as their own array jobs with resources matched to their tools
+    align_threads = max(cfg.get("tools","STAR","threads",default=1), cfg.get("tools","samtools","threads",default=1))
+    step_threads = {
+        "trim": cfg.get("tools","fastp","threads",default=1),
+        "align": align_threads,
+        "count": cfg.get("tools","featureCounts","threads",default=1)
+    }
+    step_mem = {
+        "trim": cfg.get("tools","fastp","memory",default="8G"),
+        "align": get_total_memory(cfg, align_threads),
+        "count": cfg.get("tools","featureCounts","memory",default="8G")
+    }
+
+    # convert a memory string to bytes so group sizing can take a max across steps
+    unit_scale = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    def mem_bytes(mem: str):
+        mem = str(mem)
+        unit = mem[-1].upper()
+        if unit in unit_scale:
+            return int(float(mem[:-1]) * unit_scale[unit])
+        return int(mem)
 
     # ---------------------------------------------------
-    # build sbatch command
+    # group steps by data handoff, submit groups as dependent array jobs
     # ---------------------------------------------------
-    
-    cmd = (
-        f"sbatch "
-        f"--array=0-{num_samples - 1} "
-        f"--cpus-per-task={max_threads} "
-        f"--mem={total_mem} "
-        f"--job-name={jobname} "
-        f"{run_script_path} "
-        f"--root {shlex.quote(args.root)} "
-        f"--indir {shlex.quote(args.indir)} "
-        f"--steps {steps} "
-        f"--conda-env {shlex.quote(conda_env)}"
-    )
 
-    # run subprocess and log
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    log_subprocess(result, project_dir, "launcher")
+    # a job boundary is only legal where the downstream step can find its input on
+    # shared storage: trim hands align its trimmed fastqs through node-local scratch
+    # (deleted when the task exits), and align hands count the cleaned bam in the temp
+    # dir unless it is saved as a bam, so those pairs must share a job or the later
+    # step would silently fall back to the raw/missing inputs
+    bam_saved = bool(cfg.get("project","save_files")) and cfg.get("project","save_type") == "bam"
+    requested = [s for s in ["trim","align","count"] if s in args.steps]
+    groups = []
+    for step in requested:
+        if groups and groups[-1][-1] == "trim" and step == "align":
+            groups[-1].append(step)
+        elif groups and groups[-1][-1] == "align" and step == "count" and not bam_saved:
+            groups[-1].append(step)
+        else:
+            groups.append([step])
+
+    def submit_group(steps: list, dependency=None):
+        """
+        submits a group of pipeline steps as one sbatch array job and returns its job id
+        the group is sized for its most demanding step, aftercorr ties array element i
+        of this job to element i of the previous group so each sample flows through
+        the pipeline independently
+        """
+        threads = max(step_threads[s] for s in steps)
+        mem = max((step_mem[s] for s in steps), key=mem_bytes)
+        label = "_".join(steps)
+
+        # argv list passed straight to sbatch, no shell in between so no quoting needed
+        cmd = [
+            sbatch_bin,
+            "--parsable",
+            f"--array=0-{num_samples - 1}",
+            f"--cpus-per-task={threads}",
+            f"--mem={mem}",
+            f"--job-name={name}_{label}",
+            # pass the resource math down so every array task skips recomputing it from config
+            f"--export=ALL,RNASEQ_MAX_THREADS={threads},RNASEQ_TOTAL_MEM={mem}"
+        ]
+        if dependency:
+            cmd.append(f"--dependency=aftercorr:{dependency}")
+        cmd.extend([
+            run_script_path,
+            "--root", args.root,
+            "--indir", args.indir,
+            "--steps", *steps,
+            "--conda-env", str(conda_env)
+        ])
+
+        # capture just the job id (--parsable), log the submission
+        result = subprocess.run(cmd, shell=False, capture_output=True, text=True)
+        log_subprocess(result, project_dir, f"launcher_{label}")
+        if result.returncode != 0:
+            raise RuntimeError(f"sbatch submission for steps {label} failed:\n{result.stderr}")
+
+        # --parsable prints jobid (or jobid;cluster), take the id part
+        return result.stdout.strip().split(";")[0]
+
+    # submit groups in pipeline order, each depending on the previous one
+    job_id = None
+    for group in groups:
+        job_id = submit_group(group, dependency=job_id)
+        threads = max(step_threads[s] for s in group)
+        mem = max((step_mem[s] for s in group), key=mem_bytes)
+        print(f"Submitted {'+'.join(group)} array job {job_id} ({num_samples} samples, {threads} cpus, {mem} mem)")
 
 if __name__ == "__main__":
     launcher()
\ No newline at end of file
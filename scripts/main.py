@@ -1,7 +1,9 @@
 # region Imports
 
 from pathlib import Path
-import argparse,shutil,sys,json
+import argparse,shutil,sys,json,os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -9,12 +11,11 @@ root_dir = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(root_dir))
 
 from src.config_loader import ConfigLoader
-from src.utils import generate_paired_samples, get_scratch, find_name
-from src.fastp_wrapper import QCTrimmer
-from src.star_wrapper import STARIndexBuilder, STARAligner
-from src.samtools_wrapper import SamtoolsWrapper
-from src.featureCounts_wrapper import FeatureCountsWrapper
-from src.counts import Counts
+from src.utils import get_scratch, find_name, fast_move
+from src.sample_cache import paired_samples_cached
+
+# tool wrappers are imported lazily inside the step branches so eg a trim-only
+# array task never pays the import cost of the align/count stack
 
 # endregion
 
@@ -59,8 +60,177 @@ def parse_args():
         help="Piepeline steps to run (trim, align, or count)"
     )
 
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of samples to process in parallel when running locally (ignored under SLURM arrays)"
+    )
+
     return parser.parse_args()
 
+def process_sample(cfg: ConfigLoader, root_dir: Path, run_dir: Path, temp_dir: Path, r1: Path, r2: Path, steps: list):
+    """
+    Runs the requested pipeline steps on a single sample pair
+    module level so it can be dispatched to worker processes when --workers > 1
+    Params:
+        cfg                         ConfigLoader object that has loaded config.yaml for this project
+        root_dir                    Path to root dir of the pipeline
+        run_dir                     directory for this run's outputs (root/run_name)
+        temp_dir                    Path to temp dir for intermediate files
+        r1                          Path to forward read fastq file
+        r2                          Path to reverse read fastq file
+        steps                       list of pipeline steps to run (trim, align, count)
+    """
+
+    # get name of the sample, create sample and log dirs in run dir
+    # run_dir is guaranteed by main() so plain mkdir on the two leaves avoids re-statting every
+    # ancestor the way mkdir(parents=True) does, which adds up on NFS/Lustre over many samples
+    name = find_name(r1,r2)
+    sample_dir = run_dir / name
+    log_dir = sample_dir / "logs"
+    try:
+        os.mkdir(sample_dir)
+    except FileExistsError:
+        pass
+    try:
+        os.mkdir(log_dir)
+    except FileExistsError:
+        pass
+
+    # --------------------------
+    # fastp
+    # --------------------------
+
+    if "trim" in steps:
+        from src.fastp_wrapper import QCTrimmer
+        # generate QC object
+        qc = QCTrimmer(cfg,root_dir,temp_dir,sample_dir)
+        # run QC and trim
+        trimmed_r1,trimmed_r2 = qc.run_fastp(r1,r2)
+        print(f"\nFastP copmlete\n")
+
+    # --------------------------
+    # STAR
+    # --------------------------
+
+    if "align" in steps:
+        from src.star_wrapper import STARAligner
+
+        # instantiate aligner (index is built once in main before samples are dispatched)
+        aligner = STARAligner(cfg, root_dir, temp_dir, sample_dir)
+        # input trimmed/untrimmed data based on user specifications and align
+        if "trim" in steps:
+            aligned_file = aligner.align(trimmed_r1, trimmed_r2, cleanup=True)
+        else:
+            aligned_file = aligner.align(r1,r2)
+        print(f"Align complete\n")
+
+        # copy star log files to sample dir, scandir uses the cached dir entry info instead of statting each file
+        temp_sample_dir = temp_dir / name
+        with os.scandir(temp_sample_dir) as it:
+            star_logs = [Path(e.path) for e in it if e.is_file(follow_symlinks=False) and "Log" in e.name]
+        for file in star_logs:
+            # reuse the log_dir Path bound at the top instead of rebuilding sample_dir/"logs" per file
+            new_file = log_dir / f"STAR_{file.name}"
+            try:
+                shutil.copy(file, new_file)
+            except Exception as e:
+                print(f"Warning, could not copy file:\n{file.name}\nto:\n{sample_dir}\nError:\n{e}\n")
+                continue
+            try:
+                file.unlink()
+                print(f"STAR log copy successful, deleted origonal file:\n{file.name}\n")
+            except Exception as e:
+                print(f"Warning, could not delete origonal log file:\n{file}\nError:\n{e}\n")
+
+
+    # --------------------------
+    # samtools
+    # --------------------------
+
+    # need an aligned bam file for further processing
+    if "align" in steps:
+        from src.samtools_wrapper import SamtoolsWrapper
+
+        # isntantiate wrapper
+        st = SamtoolsWrapper(cfg, root_dir, temp_dir, sample_dir)
+
+        # sort, filter, and index in one fused pipeline so the bam only crosses the disk once
+        clean_file, bam_idx = st.sort_filter_index(aligned_file)
+        print(f"Samtools sort,filter, and/or index complete\n")
+
+    # --------------------------
+    # featureCounts
+    # --------------------------
+
+    if "count" in steps:
+        if "align" not in steps:
+            bam_files = list(sample_dir.glob("*.bam"))
+            if not bam_files:
+                raise FileNotFoundError(f"No BAM file found at {sample_dir}")
+            clean_file = bam_files[0]
+        from src.featureCounts_wrapper import FeatureCountsWrapper
+        fc = FeatureCountsWrapper(cfg, root_dir, sample_dir)
+        fc.count_features(clean_file)
+        print(f"FeatureCounts count complete\n")
+
+    # --------------------------
+    # save outputs
+    # --------------------------
+
+    # saving runs after counting on purpose: the cram conversion deletes the bam it
+    # converts, so doing it earlier would remove the file featureCounts is about to read
+    if "align" in steps and cfg.get("project","save_files"):
+
+        # see if we are saving as a cram or bam
+        save_type = cfg.get("project","save_type")
+
+        # if save type is cram then cram the file and save cram/crai
+        if save_type == "cram":
+
+            # cram and index
+            cram_file = st.cram_file(clean_file)
+            cram_idx = st.index_file(cram_file,cram=True)
+
+            # get genome.fasta file path
+            ref_dir = root_dir / "reference"
+            genome = cfg.get_path("reference","genome_fasta",base_path=ref_dir)
+            # build new path to save copy at
+            genome_path = run_dir / genome.name
+
+            # move to new location, rename/hardlink when possible so multi GB files are not rewritten
+            fast_move(cram_file, sample_dir / cram_file.name)
+            fast_move(cram_idx, sample_dir / cram_idx.name)
+
+            # keep the reference in place, hard link it so no bytes are copied when on the same filesystem
+            if not genome_path.exists():
+                try:
+                    os.link(genome, genome_path)
+                except OSError:
+                    shutil.copy(genome, genome_path)
+
+        # if not cram then save bam/bai
+        else:
+
+            # save loation of new clean file
+            new_clean = sample_dir / clean_file.name
+
+            # move bam/bai to new location, rename/hardlink when possible so multi GB files are not rewritten
+            fast_move(clean_file, new_clean)
+            fast_move(bam_idx, sample_dir / bam_idx.name)
+
+            # update clean_file location
+            clean_file = new_clean
+
+    # delete star temp dir
+    strtmp = root_dir / "_STARtmp"
+    try:
+        strtmp.unlink()
+    except Exception as e:
+        print(f"Warning, could not delete _STARtmp folder after run")
+
 def main():
 
     """
@@ -104,158 +274,55 @@ def main():
     # path to dir containing raw data
     in_path = Path(args.indir)
 
-    # generate paired samples list
-    paired_samples = generate_paired_samples(in_path, args.sample1, args.sample2)
-    
+    # generate paired samples list (cached on the input dir mtime so array tasks skip repeat scans)
+    paired_samples = paired_samples_cached(in_path, args.sample1, args.sample2)
+
+    # if we are a SLURM array task then only process the pair for our task index
+    # pairing is sorted by filename so every array task sees the same ordering
+    task_id = os.environ.get("SLURM_ARRAY_TASK_ID")
+    if task_id is not None and not (args.sample1 or args.sample2):
+        idx = int(task_id)
+        if idx >= len(paired_samples):
+            raise IndexError(f"SLURM_ARRAY_TASK_ID {idx} out of range for {len(paired_samples)} sample pairs")
+        paired_samples = [paired_samples[idx]]
+
     # ---------------------------------------------------
     # run pipeline
     # ---------------------------------------------------
 
-    for r1,r2 in paired_samples:
-        
-        # get name of the sample, create sample and log dirs in run dir
-        name = find_name(r1,r2)
-        sample_dir = run_dir / name
-        log_dir = sample_dir / "logs"
-        for entry in [sample_dir,log_dir]:
-            entry.mkdir(parents=True,exist_ok=True)
-
-        # --------------------------
-        # fastp
-        # --------------------------
-
-        if "trim" in args.steps:
-            # generate QC object
-            qc = QCTrimmer(cfg,root_dir,temp_dir,sample_dir)
-            # run QC and trim
-            trimmed_r1,trimmed_r2 = qc.run_fastp(r1,r2)
-            print(f"\nFastP copmlete\n")
-
-        # --------------------------
-        # STAR
-        # --------------------------
-        
-        if "align" in args.steps:
-            
-            # check if index is already built
-            star_idx_dir = cfg.get_path("reference","star_index",base_path = ref_dir)
-            # if not then build index
-            if not star_idx_dir.exists() or not any(star_idx_dir.iterdir()):
-                index_builder = STARIndexBuilder(cfg,root_dir,temp_dir)
-                index_builder.build_index()
-
-            # instantiate aligner
-            aligner = STARAligner(cfg, root_dir, temp_dir, sample_dir)
-            # input trimmed/untrimmed data based on user specifications and align
-            if "trim" in args.steps:
-                aligned_file = aligner.align(trimmed_r1, trimmed_r2, cleanup=True)
-            else:
-                aligned_file = aligner.align(r1,r2)
-            print(f"Align complete\n")
-
-            # copy star log files to sample dir
-            temp_sample_dir = temp_dir / name
-            for file in temp_sample_dir.iterdir():
-                if file.is_file() and "Log" in file.name:
-                    new_file = sample_dir / "logs" / f"STAR_{file.name}"
-                    try:
-                        shutil.copy(file, new_file)
-                    except Exception as e:
-                        print(f"Warning, could not copy file:\n{file.name}\nto:\n{sample_dir}\nError:\n{e}\n")
-                        continue
-                    try:
-                        file.unlink()
-                        print(f"STAR log copy successful, deleted origonal file:\n{file.name}\n")
-                    except Exception as e:
-                        print(f"Warning, could not delete origonal log file:\n{file}\nError:\n{e}\n")
-
-
-        # --------------------------
-        # samtools
-        # --------------------------
-
-        # need an aligned bam file for further processing
-        if "align" in args.steps:
-
-            # isntantiate wrapper
-            st = SamtoolsWrapper(cfg, root_dir, temp_dir, sample_dir)
-
-            # sort, filter, and index
-            sorted_file = st.sort_file(aligned_file)
-            clean_file = st.filter_file(sorted_file)
-            bam_idx = st.index_file(clean_file)
-
-            # see if we are saving as a cram or bam
-            save_type = cfg.get("project","save_type")
-           
-            # save file/index to sample dir if specified
-            if cfg.get("project","save_files"):
-
-                # if save type is cram then cram the file and save cram/crai
-                if save_type == "cram":
-
-                    # cram and index
-                    cram_file = st.cram_file(clean_file)
-                    cram_idx = st.index_file(cram_file,cram=True)
-
-                    # get genome.fasta file path
-                    genome = cfg.get_path("reference","genome_fasta",base_path=ref_dir)
-                    # build new path to save copy at
-                    genome_path = run_dir / genome.name
-
-                    # copy to new location
-                    shutil.copy(cram_file, sample_dir / cram_file.name)
-                    shutil.copy(cram_idx, sample_dir / cram_idx.name)
-                    shutil.copy(genome, genome_path)
-
-                    # delete old files
-                    try:
-                        cram_file.unlink()
-                        cram_idx.unlink()
-                    except Exception as e:
-                        print(f"Warning: could not delete origonal file and index after samtools cleaning and conversion to CRAM\n{e}")
-                
-                # if not cram then save bam/bai
-                else:
-
-                    # save loation of new clean file
-                    new_clean = sample_dir / clean_file.name
-
-                    # copy bam/bai to new location
-                    shutil.copy(clean_file, new_clean)
-                    shutil.copy(bam_idx, sample_dir / bam_idx.name)
-                    
-                    # delete old files
-                    try:
-                        clean_file.unlink()
-                        bam_idx.unlink()
-                    except Exception as e:
-                        print(f"Warning: could not delete origonal file and index after samtools cleaning\n{e}")
-
-                    # update clean_file location
-                    clean_file = new_clean
-            print(f"Samtools sort,filter, and/or index complete\n")
-
-        # --------------------------
-        # featureCounts
-        # --------------------------
-
-        if "count" in args.steps:
-            if "align" not in args.steps:
-                bam_files = list(sample_dir.glob("*.bam"))
-                if not bam_files:
-                    raise FileNotFoundError(f"No BAM file found at {sample_dir}")
-                clean_file = bam_files[0]
-            fc = FeatureCountsWrapper(cfg, root_dir, sample_dir)
-            fc.count_features(clean_file)
-            print(f"FeatureCounts count complete\n")
-
-        # delete star temp dir
-        strtmp = root_dir / "_STARtmp"
-        try:
-            strtmp.unlink()
-        except Exception as e:
-            print(f"Warning, could not delete _STARtmp folder after run")
+    # build the STAR index once up front so parallel workers never race to build it
+    if "align" in args.steps:
+        star_idx_dir = cfg.get_path("reference","star_index",base_path = ref_dir)
+        if not star_idx_dir.exists() or not any(star_idx_dir.iterdir()):
+            from src.star_wrapper import STARIndexBuilder
+            index_builder = STARIndexBuilder(cfg,root_dir,temp_dir)
+            index_builder.build_index()
+
+    # preload the STAR index into shared memory once for local multi-sample runs so
+    # every alignment mmaps the same copy, the context exports the LoadAndKeep override
+    # through the env for the per-sample aligners (SLURM array tasks are separate
+    # allocations, each loads its own copy so they skip the context)
+    if "align" in args.steps and task_id is None and len(paired_samples) > 1:
+        from src.star_wrapper import STARAligner
+        star_shm = STARAligner(cfg, root_dir, temp_dir, run_dir)
+    else:
+        star_shm = nullcontext()
+
+    with star_shm:
+        # dispatch samples to a process pool when running locally with --workers > 1
+        if task_id is None and args.workers > 1 and len(paired_samples) > 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [
+                    executor.submit(process_sample, cfg, root_dir, run_dir, temp_dir, r1, r2, args.steps)
+                    for r1,r2 in paired_samples
+                ]
+                # surface any worker exceptions
+                for future in futures:
+                    future.result()
+        # otherwise run samples sequentially
+        else:
+            for r1,r2 in paired_samples:
+                process_sample(cfg, root_dir, run_dir, temp_dir, r1, r2, args.steps)
 
     # delete temp dir files
     for item in temp_dir.iterdir():
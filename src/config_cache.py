@@ -0,0 +1,52 @@
+# region Imports
+
+from pathlib import Path
+import functools, pickle
+import yaml
+
+# prefer the libyaml backed C loader (several times faster), fall back to pure python
+# if pyyaml was built without the C extension (pip users: libyaml-dev + pip install --no-binary pyyaml pyyaml)
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+# endregion
+
+@functools.lru_cache(maxsize=32)
+def load_config(path_str: str, mtime_ns: int):
+    """
+    Loads and parses a yaml config file, cached so repeat loads within a process are free
+    keyed on (path, mtime) so an edited config busts the cache instead of serving stale values
+    also keeps a pickled sidecar (config.yaml.pkl) next to the yaml so later processes (eg each SLURM array task)
+    can skip the yaml parse entirely, pickle.load is much faster than yaml.safe_load on dict trees
+    Params:
+        path_str:               string path to the yaml config file
+        mtime_ns:               st_mtime_ns of the yaml file, pass p.stat().st_mtime_ns (part of the cache key)
+    Returns:
+        parsed config dict
+    """
+    path = Path(path_str)
+    sidecar = path.with_suffix(path.suffix + ".pkl")
+
+    # if the sidecar is at least as new as the yaml then load it instead of parsing
+    try:
+        if sidecar.stat().st_mtime_ns >= mtime_ns:
+            with open(sidecar, "rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        # missing/corrupt sidecar, fall through to the yaml parse
+        pass
+
+    # parse the yaml file, binary mode hands raw bytes to the C parser without a python-level decode
+    with open(path, "rb") as f:
+        config = yaml.load(f, Loader=_YamlLoader)
+
+    # refresh the sidecar for the next process, skip quietly if the dir is read only
+    try:
+        with open(sidecar, "wb") as f:
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+    return config
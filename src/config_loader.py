@@ -1,7 +1,27 @@
 # region Imports
 
 from pathlib import Path
-import yaml, os
+import sys, os
+
+# location of pipeline root dir
+root_dir = Path(__file__).resolve().parent.parent
+# tell python to look here for modules
+sys.path.insert(0, str(root_dir))
+
+from src.config_cache import load_config
+
+# config fields that must parse as booleans, hoisted to module scope so check_bools
+# does not rebuild the set on every call
+BOOL_FIELDS = frozenset({
+    "save_files",
+    "specify_adapter",
+    "outReadsUnmapped",
+    "chromosome",
+    "isPairedEnd",
+    "largestOverlap",
+    "ignoreDup",
+    "countFraction"
+})
 
 # endregion
 
@@ -19,20 +39,56 @@ class ConfigLoader:
 
         if not self.config_path.exists():
             raise FileNotFoundError(f"Config file at {config_file} not found")
-        
-        with open(self.config_path, "r") as f:
-            self.config = yaml.safe_load(f)
 
-    def get(self, *keys: str, default=None):
+        # cached load keyed on (path, mtime) so repeat ConfigLoader constructions skip the yaml parse
+        self.config = load_config(str(self.config_path), self.config_path.stat().st_mtime_ns)
+
+        # flatten leaves into a dotted-path dict once so get() is a single hash lookup for leaf values
+        self._flat = {}
+        self._flatten(self.config, "")
+
+        # parse samtools sortMemory into a (value, unit) tuple once at load so every
+        # consumer skips the string slicing, and a malformed value fails here instead
+        # of partway through a run
+        self.sort_memory = None
+        mem_str = self.get("tools","samtools","sortMemory")
+        if mem_str is not None:
+            mem_str = str(mem_str)
+            unit = mem_str[-1:].upper()
+            if unit not in ("G","M"):
+                raise ValueError(f"Unknown memory unit: {unit} must be G (gigabytes) or M (megabytes)")
+            # the value is almost always a whole number of G/M, keep it an int in that
+            # case so consumers do pure integer arithmetic, floats only for odd configs
+            num_part = mem_str[:-1]
+            try:
+                value = int(num_part)
+            except ValueError:
+                try:
+                    value = float(num_part)
+                except ValueError:
+                    raise ValueError(f"could not convert memory value {num_part} to number")
+            self.sort_memory = (value, unit)
+
+    def _flatten(self, value: dict, prefix: str):
         """
-        accesses nested values from config dict
-        params:
-            keys:                   list of keys in order of accessing for config structure
-                example:            cfg.get("params","star","threads") returns number of threads tasked to star package
+        recursively flattens the nested config into self._flat with dotted-path keys
+        only leaf values land here, subdicts are still reachable through the nested walk
+        """
+        for k,v in value.items():
+            current_path = f"{prefix}.{k}" if prefix else k
+            # go a layer deeper for subdicts, store leaves
+            if isinstance(v,dict):
+                self._flatten(v,current_path)
+            else:
+                self._flat[current_path] = v
+
+    def _walk(self, keys: tuple, default=None):
+        """
+        walks the nested config dict for the given key tuple, the uncached lookup path
         """
 
         value = self.config
-        
+
         # iterates over all keys given going into each key subsection at each iteartion
         for key in keys:
 
@@ -41,12 +97,29 @@ class ConfigLoader:
             # ensures key is a dict
             if not isinstance(value,dict):
                 return default
-            
+
             # resets value (dict) to the value under key, if key is a subdict name it reaturns that dict
             value = value.get(key, default)
-        
+
         # return value queried for
         return value
+
+    def get(self, *keys: str, default=None):
+        """
+        accesses nested values from config dict
+        params:
+            keys:                   list of keys in order of accessing for config structure
+                example:            cfg.get("params","star","threads") returns number of threads tasked to star package
+        """
+        # leaf values resolve with one hash lookup on the flattened dict
+        flat_key = ".".join(keys)
+        if flat_key in self._flat:
+            return self._flat[flat_key]
+
+        # intermediate keys (eg cfg.get("tools") returning a subdict) fall back to the
+        # nested walk, these lookups are rare so no memo is kept for them (a per-instance
+        # lru_cache here would make the loader unpicklable for the process pool workers)
+        return self._walk(keys, default)
     
     def get_threads(self, tool_name: str):
         """
@@ -83,39 +156,13 @@ class ConfigLoader:
 
     def check_bools(self):
 
-        # empty list to hold improperly formatted bools
-        errors = []
-
-        # list of fields that must be boolean
-        bool_fields = {
-            "save_files",
-            "specify_adapter",
-            "outReadsUnmapped",
-            "chromosome",
-            "isPairedEnd",
-            "largestOverlap",
-            "ignoreDup",
-            "countFraction"
-        }
-
-        # recursive function to enter parent dicts
-        def recurse(value, path=""):
-            # check each key value pair
-            for k,v in value.items():
-                # get string representation of current value being observed
-                current_path = f"{path}.{k}" if path else k
-                # if value is a dict then go another layer deeper
-                if isinstance(v,dict):
-                    recurse(v,current_path)
-                # if not a dict, check if it is in bool_fields and if it is properly formatted as bool
-                else:
-                    # if imrpoperly formatted then append it to errors list
-                    if k in bool_fields and not isinstance(v,bool):
-                        errors.append(current_path)
-        
-        # run recursive method on loaded config dict
-        recurse(self.config)
-        
+        # the flattened dict already has every leaf with its dotted path, so validation
+        # is one linear pass instead of a recursive walk with per-dict allocations
+        errors = [
+            k for k,v in self._flat.items()
+            if k.rsplit(".",1)[-1] in BOOL_FIELDS and not isinstance(v,bool)
+        ]
+
         # output error/all good message
         if errors:
             raise ValueError(
@@ -1,11 +1,12 @@
 # region Imports
 
-import sys,json
+import sys,json,mmap
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# matplotlib and sklearn are imported lazily inside pca/plot_pca, importing them here
+# made every module that touches src pay their load time even when no plots are made
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -33,35 +34,55 @@ class Counts:
         self.data_dir = Path(root) / name
 
     @staticmethod
-    def parse_count(file: Path):
+    def parse_count_arrays(file: Path):
         """
-        Parses a single featureCounts count file and generates a summary dict
+        Parses a single featureCounts count file into parallel gene/count arrays
+        reads the file as bytes in one shot and leaves the count-string to int conversion to numpy,
+        much faster than a per-line python loop with strip/split/int for files with tens of thousands of rows
         Params:
-            file                        Path to the file you want to extract to dict
+            file                        Path to the file you want to parse
         Returns:
-            a dict that contians [geneID]:count key:value pairs for this file
+            (ids, vals) where ids is a list of geneID strings and vals is an int64 numpy array of counts
         """
 
-        # init output dict
-        counts = {}
-        # header flag
-        header = False
+        # mmap the file and snapshot the bytes, counts files are ASCII so no decode pass is
+        # needed and mmap lets the kernel page the file in without an extra read buffer copy
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[:]
+        lines = data.split(b"\n")
+
+        # skip over starting comments then the header row
+        start = 0
+        while start < len(lines) and lines[start].startswith(b"#"):
+            start += 1
+        start += 1
 
-        with open(file, "r") as f:
-            for line in f:
+        # first field is the gene id, last field is the count
+        ids = []
+        raw_vals = []
+        for line in lines[start:]:
+            if not line:
+                continue
+            ids.append(line[:line.find(b"\t")].decode())
+            raw_vals.append(line[line.rfind(b"\t")+1:])
 
-                # skip over starting comments/header
-                if line.startswith("#"):
-                    continue
-                if not header:
-                    header = True
-                    continue
-                
-                # split the line into parts at each tab
-                parts = line.strip().split("\t")
-                counts[parts[0]] = int(parts[-1])
+        # numpy casts the byte strings to ints in C instead of per-value python int() calls
+        vals = np.array(raw_vals).astype(np.int64)
 
-        return counts
+        return ids, vals
+
+    @staticmethod
+    def parse_count(file: Path):
+        """
+        Parses a single featureCounts count file and generates a summary dict
+        Params:
+            file                        Path to the file you want to extract to dict
+        Returns:
+            a dict that contians [geneID]:count key:value pairs for this file
+        """
+        # dict view over the array parse for callers that want key:value access
+        ids, vals = Counts.parse_count_arrays(file)
+        return dict(zip(ids, vals.tolist()))
 
     @staticmethod
     def preprocess_filter(matrix: np.ndarray, threshold: int=10):
@@ -74,8 +95,11 @@ class Counts:
             filtered_matrix                 matrix with low expressing values removed
         """
 
-        keep_values = (matrix >= threshold).sum(axis=0) >= (0.5 * matrix.shape[0])
-        filtered_matrix = matrix[:,keep_values]
+        # count_nonzero reduces the comparison directly instead of materializing a bool
+        # matrix and summing it through an int64 accumulator
+        keep_values = np.count_nonzero(matrix >= threshold, axis=0) >= (0.5 * matrix.shape[0])
+        # contiguous copy so the downstream cpm/log passes work on unstrided memory
+        filtered_matrix = np.ascontiguousarray(matrix[:,keep_values])
 
         return filtered_matrix
     
@@ -90,15 +114,18 @@ class Counts:
             cpm                         normalized matrix with counts now represented in cpm
         """
         # genearte float matrix to store values in
-        float_matrix = matrix.astype(float)
+        # float32 is plenty of precision for cpm and halves the memory traffic vs float64
+        # copy=False means a float32 input is normalized in place rather than copied
+        float_matrix = matrix.astype(np.float32, copy=False)
 
         # get the library size of each sample (total counts for that column)
         library_sizes = float_matrix.sum(axis=1,keepdims=True)
 
-        # calculate counts per million by dividing each count by the library size then multiplying by 1 million
-        cpm = (float_matrix / library_sizes) * 1e6
+        # calculate counts per million in place, dividing by library size then scaling to 1 million
+        np.divide(float_matrix, library_sizes, out=float_matrix)
+        np.multiply(float_matrix, 1e6, out=float_matrix)
 
-        return cpm
+        return float_matrix
     
     @staticmethod
     def preprocess_log2(matrix: np.ndarray):
@@ -123,8 +150,13 @@ class Counts:
         Returns:
             z_matrix                        matrix of z-score values generated from input matrix
         """
-        scaler = StandardScaler()
-        z_matrix = scaler.fit_transform(matrix)
+        # two column reductions then elementwise center/scale, same math as sklearn's
+        # StandardScaler without the validation overhead or the extra full-matrix copy
+        mean = matrix.mean(axis=0)
+        std = matrix.std(axis=0)
+        # guard against zero variance columns
+        std[std == 0] = 1.0
+        z_matrix = (matrix - mean) / std
 
         return z_matrix
 
@@ -137,17 +169,29 @@ class Counts:
         # get raw matrix
         raw = self.matrix
 
-        # filter, convert to cpm then log2 and finally to zscores
-        filtered = Counts.preprocess_filter(raw, 10)
-        cpm = Counts.preprocess_cpm(filtered)
-        log2 = Counts.preprocess_log2(cpm)
-        zscore = Counts.preprocess_zscore(log2)
+        # filter low expressing genes, the column selection is the only full copy taken
+        work = Counts.preprocess_filter(raw, 10)
+
+        # convert to cpm, runs in place on the float32 buffer the filter produced
+        work = Counts.preprocess_cpm(work)
+
+        # log2(x+1) in place instead of allocating a fresh matrix
+        np.add(work, 1, out=work)
+        np.log2(work, out=work)
+
+        # zscore in place, two column reductions then elementwise center/scale
+        mean = work.mean(axis=0)
+        std = work.std(axis=0)
+        # guard against zero variance columns
+        std[std == 0] = 1.0
+        np.subtract(work, mean, out=work)
+        np.divide(work, std, out=work)
 
         # save values
         self.raw_matrix = self.matrix
-        self.matrix = zscore
+        self.matrix = work
 
-        return zscore
+        return work
     
     def summarize_counts(self):
         """
@@ -160,36 +204,39 @@ class Counts:
         # generate a list of all counts.txt files from data_dir
         count_files = list(data_dir.rglob("*_counts.txt"))
 
-        # initialize gene/sample maps and lists
-        gene_map = {}
-        genes = []
-        sample_map = {}
-        samples = []
+        # parse every count file up front on a thread pool, the parse is IO bound and
+        # threads overlap the reads while numpy does the conversions outside the GIL
+        with ThreadPoolExecutor(max_workers=min(8, len(count_files))) as executor:
+            parsed = list(executor.map(self.parse_count_arrays, count_files))
 
-        # generate gene map/genes
-        first_counts = self.parse_count(count_files[0])
-        for idx,(key,_) in enumerate(first_counts.items()):
-            gene_map[key] = idx
-            genes.append(key)
+        # generate gene map/genes from the first file
+        # dict(zip(...)) builds the index map in C instead of a per-key python loop
+        first_ids, first_vals = parsed[0]
+        genes = first_ids
+        gene_map = dict(zip(genes, range(len(genes))))
+
+        # sample names/map come straight from the file list the same way
+        samples = [file.name.replace("_counts.txt","") for file in count_files]
+        sample_map = dict(zip(samples, range(len(samples))))
 
         # initialize counts matrix (rows = samples columns = genes)
-        counts = np.zeros((len(count_files),len(gene_map)))
+        # int32 holds any realistic featureCounts value at half the footprint of the float64 default
+        counts = np.zeros((len(count_files),len(gene_map)), dtype=np.int32)
 
         # grab counts from each sample run
         for idx,file in enumerate(count_files):
 
-            # get file name and add file to map/list
-            file_name = file.name.replace("_counts.txt","")
-            sample_map[file_name] = idx
-            samples.append(file_name)
-
-            # get dict of this file's gene:count
-            data = self.parse_count(file)
+            # get this file's gene/count arrays from the parallel parse
+            ids, vals = parsed[idx]
 
-            # add each count value to the correct position in the counts matrix
-            for key,value in data.items():
-                col = gene_map[key]
-                counts[idx][col] = value
+            # featureCounts emits genes in annotation order, so every file normally matches the first
+            # exactly and the whole row lands with one C-level copy
+            if ids == first_ids:
+                counts[idx] = vals
+            # mismatched ordering falls back to fancy indexing via the gene map
+            else:
+                cols = np.fromiter((gene_map[key] for key in ids), dtype=np.intp, count=len(ids))
+                counts[idx, cols] = vals
 
         # generate summary json for the data
         summary = {
@@ -203,15 +250,33 @@ class Counts:
         self.matrix = counts
         self.metadata = summary
 
+    @staticmethod
+    def load_matrix(file: Path, lazy: bool=True):
+        """
+        loads a saved counts matrix npy file
+        Params:
+            file                        Path to the counts_matrix.npy file
+            lazy                        if True (default) the file is memory mapped so analyses that
+                                        slice a subset of rows/columns only page in what they touch
+        Returns:
+            the counts matrix (memory mapped array when lazy)
+        """
+        return np.load(file, mmap_mode="r" if lazy else None)
+
     def save_counts(self):
         """
         saves the count matrix and count metadata to data directory for this run as npy and json files respectively
+        the npy is the working copy (memory mappable via load_matrix), a compressed npz copy is
+        also written since count matrices usually shrink several fold for archiving/transfer
         """
         data_dir = self.data_dir
 
         # save numpy array
         np.save(data_dir/"counts_matrix.npy",self.matrix)
 
+        # compressed archival copy
+        np.savez_compressed(data_dir/"counts_matrix.npz", matrix=self.matrix)
+
         # save summary json
         output_file = data_dir / "counts_metadata.json"
         with open(output_file, "w") as f:
@@ -224,12 +289,16 @@ class Counts:
             comps                           Number of principal components you want to keep for this data matrix
             matrix                          The matrix you want to process
         """
+        from sklearn.decomposition import PCA
+
         # throw error if too many PCs are asked for
         if comps > min(matrix.shape[0], matrix.shape[1]):
             raise ValueError(f"Too many PCs requested, comps must be <= min(number_samples, number_genes)")
 
         # calculate principal components
-        pca = PCA(n_components=comps)
+        # randomized solver is O(N*G*comps) rather than a full SVD, a big saving since we
+        # keep a handful of PCs from tens of thousands of gene columns
+        pca = PCA(n_components=comps, svd_solver="randomized", random_state=0)
         pc_scores = pca.fit_transform(matrix)
 
         # get variance explaiend by each pc
@@ -252,6 +321,12 @@ class Counts:
                             if not provided, groups are inferred from _WT_ and _CGX_ in sample names
         """
 
+        # force the non-interactive Agg backend before pyplot loads, HPC nodes have no
+        # display and probing Qt/Tk backends wastes startup time (and can fail outright)
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
         if self.pc_scores is None:
             raise RuntimeError("No PCA components found, please run Counts.pca() first")
 
@@ -334,7 +409,8 @@ class Counts:
             out_path = self.data_dir / f"PCA_PC{pcy + 1}_vs_PC{pcx + 1}.pdf"
 
         plt.savefig(out_path, bbox_inches="tight")
-        plt.show()
+        # Agg has nothing to show, close the figure so repeated calls do not accumulate memory
+        plt.close(fig)
             
     def preprocess_pipeline(self):
         """
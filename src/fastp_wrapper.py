@@ -2,6 +2,7 @@
 
 import subprocess, sys
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -13,6 +14,22 @@ from src.config_loader import ConfigLoader
 
 # endregion
 
+# small background pool for input cleanup, unlinking multi-GB fastq.gz files can stall
+# for seconds on network filesystems and the driver does not need to wait for it
+_CLEANUP_POOL = ThreadPoolExecutor(max_workers=2)
+
+def _safe_unlink(r1_in: Path, r2_in: Path):
+    """
+    deletes the fastp input files, swallowing errors with a warning so a failed
+    cleanup never kills the pipeline
+    """
+    try:
+        r1_in.unlink()
+        r2_in.unlink()
+        print(f"FastP complete, deleted input files:\n{r1_in}\n{r2_in}\n")
+    except Exception as e:
+        print(f"Warning, could not delete FastP input files:\n{r1_in}\n{r2_in}\n")
+
 class QCTrimmer:
     """
     Class to run FastQC on one or more FastQ files
@@ -32,6 +49,31 @@ class QCTrimmer:
         self.sample_dir = Path(sample_dir)
         self.env_path = str(Path(sys.executable).parent/"fastp")
 
+        # hoist config reads and the project dir creation out of the per-sample path,
+        # none of these change between samples
+        self.project = cfg.get_path("project","name", base_path=self.root)
+        self.project.mkdir(parents=True,exist_ok=True)
+        self.threads = cfg.get_threads("fastp")
+        self.length_required = cfg.get("tools","fastp","length_required")
+        self.qualified_quality_phred = cfg.get("tools","fastp","qualified_quality_phred")
+        self.specify_adapter = cfg.get("tools", "fastp", "specify_adapter")
+        self.save_inputs = cfg.get("tools","fastp","save_inputs")
+        self.adapter_sequence = cfg.get("tools","fastp","adapter_sequence")
+        self.adapter_sequence_r2 = cfg.get("tools","fastp","adapter_sequence_r2")
+
+        # static tail of the fastp command, identical for every sample so built once here,
+        # run_fastp only splices in the per-sample IO paths
+        self._static_args = [
+            "-w", str(self.threads),
+            "--length_required", str(self.length_required),
+            "--qualified_quality_phred", str(self.qualified_quality_phred)
+        ]
+        if self.specify_adapter:
+            if self.adapter_sequence:
+                self._static_args.extend(["--adapter_sequence", self.adapter_sequence])
+            if self.adapter_sequence_r2:
+                self._static_args.extend(["--adapter_sequence_r2", self.adapter_sequence_r2])
+
     def run_fastp(self, r1_in: Path, r2_in: Path):
         """
         Runs FastP QC, trim, second QC and stores files as specified
@@ -45,24 +87,13 @@ class QCTrimmer:
         # get names for the files/sample
         name = find_name(r1_in,r2_in)
 
-        #load config
-        cfg = self.cfg
-
-        # get other dir paths
-        project = cfg.get_path("project","name", base_path=self.root)
+        # get per-sample dir paths (project dir is guaranteed by __init__)
         sample_dir = self.sample_dir
         temp_dir = self.temp_dir / name
 
         # build the directories if they do not already exist
-        for dir in [project,sample_dir,temp_dir]:
+        for dir in [sample_dir,temp_dir]:
             dir.mkdir(parents=True,exist_ok=True)
-            
-        # get other values
-        threads = cfg.get_threads("fastp")
-        length_required = cfg.get("tools","fastp","length_required")
-        qualified_quality_phred = cfg.get("tools","fastp","qualified_quality_phred")
-        specifyAdapter = cfg.get("tools", "fastp", "specify_adapter")
-        save_inputs = cfg.get("tools","fastp","save_inputs")
 
         # build output files
         r1_out = temp_dir / f"{name}_R1_trimmed.fastq.gz"
@@ -70,7 +101,7 @@ class QCTrimmer:
         html_out = sample_dir / "logs" / "fastP_QC.html"
         json_out = sample_dir / "logs" / "fastP_QC.json"
 
-        # build fastp command, ensuring that any Path objects are converted to str
+        # build fastp command from the per-sample IO paths plus the static template from __init__
         cmd = [
             self.env_path,
             "-i", str(r1_in),
@@ -79,35 +110,23 @@ class QCTrimmer:
             "-O", str(r2_out),
             "-h", str(html_out),
             "-j", str(json_out),
-            "-w", str(threads),
-            "--length_required", str(length_required),
-            "--qualified_quality_phred", str(qualified_quality_phred)
+            *self._static_args
         ]
 
-        # check if we want to specify adapters
-        if specifyAdapter:
-            # get adapter sequences
-            adapter_sequence = cfg.get("tools","fastp","adapter_sequence")
-            adapter_sequence_r2 = cfg.get("tools","fastp","adapter_sequence_r2")
-            # include specified adapters in command
-            if adapter_sequence:
-                cmd.extend(["--adapter_sequence", adapter_sequence])
-            if adapter_sequence_r2:
-                cmd.extend(["--adapter_sequence_r2", adapter_sequence_r2])
-
-        # run command
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        # log subprocess
+        # run command, streaming output straight to the log file instead of capturing,
+        # fastp can emit megabytes of per-read stderr and buffering/decoding that in
+        # the driver is wasted memory and CPU
+        log_file = sample_dir / "logs" / "fastP.log"
+        log_file.parent.mkdir(parents=True,exist_ok=True)
+        with open(log_file, "wb") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
+
+        # log subprocess (returncode only, the output already lives in fastP.log)
         log_subprocess(result, sample_dir, "fastP")
 
-        if r1_out.exists() and r2_out.exists() and not save_inputs:
-            try:
-                r1_in.unlink()
-                r2_in.unlink()
-                print(f"FastP complete, deleted input files:\n{r1_in}\n{r2_in}\n")
-            except Exception as e:
-                print(f"Warning, could not delete FastP input files:\n{r1_in}\n{r2_in}\n")
+        if r1_out.exists() and r2_out.exists() and not self.save_inputs:
+            # hand the deletes to the background pool so we move on to the next sample immediately
+            _CLEANUP_POOL.submit(_safe_unlink, r1_in, r2_in)
 
         # return location of temp trimmed files
         return r1_out, r2_out
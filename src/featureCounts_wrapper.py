@@ -1,7 +1,8 @@
 # region Imports
 
 from pathlib import Path
-import sys, subprocess
+import sys, subprocess, re, os, hashlib, logging
+from concurrent.futures import ThreadPoolExecutor
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -9,7 +10,11 @@ root_dir = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(root_dir))
 
 from src.config_loader import ConfigLoader
-from src.utils import log_subprocess
+from src.utils import log_subprocess, bam_sample_name
+
+# per-module logger, a null handler by default so the per-sample messages cost nothing
+# unless the caller opts in with logging.basicConfig
+log = logging.getLogger(__name__)
 
 # endregion
 
@@ -28,73 +33,322 @@ class FeatureCountsWrapper:
         self.cfg = cfg
         self.sample_dir = Path(sample_dir)
         self.env_path = str(Path(sys.executable).parent/"featureCounts")
+        # probe the featureCounts version once, -p stopped implying pair counting in 2.0.2
+        # and older builds reject the --countReadPairs flag outright
+        self._fc_version = self._probe_version()
 
-    def count_features(self, bam_file: Path):
+        # hoist config reads and static dir creation out of the per-sample path,
+        # none of these change between samples
+        self.project = cfg.get_path("project","name",base_path=self.root)
+        self.ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
+        for dir in [self.project,self.ref_dir,self.sample_dir]:
+            dir.mkdir(parents=True,exist_ok=True)
+        self.gtf_file = cfg.get_path("reference","gtf_file",base_path=self.ref_dir)
+        self.threads = cfg.get_threads("featureCounts")
+        self.strand = cfg.get("tools","featureCounts","strand_specific")
+        self.feature_type = cfg.get("tools","featureCounts","feature_type")
+        self.gtf_attr_type = cfg.get("tools","featureCounts","gtf_attr_type")
+        self.ignoreDup = cfg.get("tools","featureCounts","ignoreDup")
+        self.isPairedEnd = cfg.get("tools","featureCounts","isPairedEnd")
+        self.save_files = cfg.get("project","save_files")
+
+        # precompile the GTF to SAF once per annotation version, featureCounts loads SAF an
+        # order of magnitude faster because there are no attribute strings to parse
+        saf_file = self._saf_annotation()
+
+        # static part of the featureCounts command, identical for every invocation so built once,
+        # the count methods only splice in the output and input paths
+        self._static_args = [
+            "-T", str(self.threads),
+            "-s", str(self.strand)
+        ]
+        if saf_file:
+            # SAF rows already carry the gene id so -t/-g do not apply
+            self._static_args.extend(["-F","SAF","-a",str(saf_file)])
+        else:
+            self._static_args.extend([
+                "-t", str(self.feature_type),
+                "-g", str(self.gtf_attr_type),
+                "-a", str(self.gtf_file)
+            ])
+        if self.ignoreDup:
+            self._static_args.append("--ignoreDup")
+        if self.isPairedEnd:
+            self._static_args.append("-p")
+            # --countReadPairs only exists from 2.0.2, older builds count pairs with -p alone
+            # and reject the long flag, so gate it on the probed version
+            if self._fc_version is None or self._fc_version >= (2,0,2):
+                self._static_args.append("--countReadPairs")
+
+        # dirs we have already created this run, saves a stat+mkdir syscall pair per
+        # count call once a dir is known to exist
+        self._ensured_dirs = set()
+
+    def _ensure(self, p: Path):
         """
-        Runs featurecounts to produce count files from bam files
+        mkdir that only hits the filesystem the first time a path is seen
         Params:
-            bam_file                    path to the bam file to be counted
+            p                           directory path to create if we have not already
         """
-        # sample name
-        name = bam_file.stem.split("_Aligned")[0]
+        if p not in self._ensured_dirs:
+            p.mkdir(parents=True,exist_ok=True)
+            self._ensured_dirs.add(p)
+
+    def _saf_annotation(self):
+        """
+        Returns the path to a cached SAF conversion of the configured GTF, building it on first use
+        the cache is keyed on the GTF's size+mtime (same pattern as the config/sample caches) so an
+        updated annotation rebuilds it, later samples and later processes all reuse the file
+        Returns:
+            path to the .saf file, or None if the GTF can not be converted
+            (featureCounts then just loads the GTF itself)
+        """
+        try:
+            st = os.stat(self.gtf_file)
+            digest = hashlib.blake2b(
+                f"{self.gtf_file}|{st.st_size}|{st.st_mtime_ns}".encode(),
+                digest_size=8
+            ).hexdigest()
+            saf_file = self.ref_dir / f"annot.{digest}.saf"
+            if saf_file.exists():
+                return saf_file
+
+            # pull the gene id out of the attribute column with the configured attribute key
+            attr_re = re.compile(rf'{re.escape(str(self.gtf_attr_type))} "([^"]+)"')
+            feature_type = str(self.feature_type)
 
-        # connect to config
-        cfg = self.cfg
+            # build to a per-process temp name and rename so a crashed run never leaves a
+            # half written cache, the pid suffix keeps concurrent array tasks racing on a
+            # cold cache from interleaving writes into one shared build file
+            tmp_file = saf_file.with_name(f"{saf_file.name}.{os.getpid()}.tmp")
+            rows = 0
+            with open(self.gtf_file,"r") as gtf, open(tmp_file,"w") as saf:
+                saf.write("GeneID\tChr\tStart\tEnd\tStrand\n")
+                for line in gtf:
+                    if line.startswith("#"):
+                        continue
+                    fields = line.split("\t")
+                    if len(fields) < 9 or fields[2] != feature_type:
+                        continue
+                    match = attr_re.search(fields[8])
+                    if not match:
+                        continue
+                    saf.write(f"{match.group(1)}\t{fields[0]}\t{fields[3]}\t{fields[4]}\t{fields[6]}\n")
+                    rows += 1
 
-        # get dirs
-        project = cfg.get_path("project","name",base_path=self.root)
-        ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
+            # an empty conversion means the feature/attribute settings did not match this GTF
+            if rows == 0:
+                tmp_file.unlink(missing_ok=True)
+                return None
+            os.replace(tmp_file, saf_file)
+            return saf_file
+        except OSError:
+            return None
+
+    def _probe_version(self):
+        """
+        Runs featureCounts -v once and parses the version into a comparable tuple
+        Returns:
+            (major, minor, patch) tuple, or None if the binary/version can not be read
+        """
+        try:
+            result = subprocess.run([self.env_path,"-v"],capture_output=True,text=True)
+            # version prints like "featureCounts v2.0.6" (on stderr for most builds)
+            match = re.search(r"v(\d+)\.(\d+)\.(\d+)", result.stderr + result.stdout)
+            if match:
+                return tuple(int(g) for g in match.groups())
+        except OSError:
+            pass
+        return None
+
+    def count_features_batch(self, bam_files: list, out_file: Path = None):
+        """
+        Runs featureCounts once over a list of bam files, producing a single combined count matrix
+        featureCounts re-parses the GTF annotation on every invocation, so counting K samples one
+        at a time pays that load K times, one batched call pays it once
+        Params:
+            bam_files                   list of paths to the bam files to be counted
+            out_file                    optional path for the combined matrix, defaults to counts.txt in the project dir
+        Returns:
+            path to the combined counts matrix
+        """
         sample_dir = self.sample_dir
-        # make sure dirs exist
-        for dir in [project,ref_dir,sample_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
 
-        # get other values
-        gtf_file = cfg.get_path("reference","gtf_file",base_path=ref_dir)
-        threads = cfg.get_threads("featureCounts")
-        strand = cfg.get("tools","featureCounts","strand_specific")
-        feature_type = cfg.get("tools","featureCounts","feature_type")
-        gtf_attr_type = cfg.get("tools","featureCounts","gtf_attr_type")
-        ignoreDup = cfg.get("tools","featureCounts","ignoreDup")
-        isPairedEnd = cfg.get("tools","featureCounts","isPairedEnd")
-        save_files = cfg.get("project","save_files")
+        # build output file, one matrix shared by every input bam
+        if out_file is None:
+            out_file = self.project / "counts.txt"
 
+        # build command from the static template plus the output and input paths
+        cmd = [self.env_path, *self._static_args, "-o", str(out_file)]
 
-        # build output file
+        # append all input files, featureCounts emits one count column per bam
+        cmd.extend(str(b) for b in bam_files)
+
+        # run subprocess, streaming output straight to the log file instead of buffering
+        # it through the driver, featureCounts prints a progress table per bam
+        log_file = sample_dir / "logs" / "featureCounts.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
+
+        # log subprocess (returncode only, the output already lives in featureCounts.log)
+        log_subprocess(result,sample_dir,"featureCounts_batch")
+
+        # if we are not saving files then delete the input bams
+        if out_file.exists() and not self.save_files:
+            for bam_file in bam_files:
+                try:
+                    bam_file.unlink()
+                    log.debug(f"FeatureCount successful, deleted input bam:\n{bam_file}\n")
+                except Exception as e:
+                    log.warning(f"Warning, could not delete file:\n{bam_file}\nError:\n{e}\n")
+
+        return out_file
+
+    def count_features_many(self, bam_files: list):
+        """
+        Counts a list of bam files concurrently, one featureCounts process per worker
+        the worker count is sized so (workers x threads per featureCounts) stays within the
+        host's cores, threads are enough because each worker just blocks on an external
+        C process so the GIL never gets in the way
+        Params:
+            bam_files                   list of paths to the bam files to be counted
+        """
+        # how many featureCounts processes fit within the cpu budget
+        workers = max(1, (os.cpu_count() or 1) // max(1, self.threads))
+
+        # nothing to gain from a pool with one worker or one file
+        if workers == 1 or len(bam_files) <= 1:
+            for bam_file in bam_files:
+                self.count_features(bam_file)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.count_features, b) for b in bam_files]
+            # surface any worker exception instead of failing silently
+            for future in futures:
+                future.result()
+
+    def count_features_sharded(self, bam_file: Path, chroms: list = None):
+        """
+        Counts one bam by splitting it per chromosome and counting the shards concurrently
+        featureCounts -T scales poorly past ~8 threads on a single bam because the workers
+        synchronize on the shared input, per-chromosome shards sidestep that ceiling
+        the bam must be indexed (the fused samtools step emits the index already)
+        Params:
+            bam_file                    path to the indexed bam file to be counted
+            chroms                      optional list of chromosome names to shard on, defaults to
+                                        every chromosome with mapped reads (from idxstats)
+        Returns:
+            path to the merged per-sample counts file
+        """
+        name = bam_sample_name(str(bam_file))
+        sample_dir = self.sample_dir
+        shard_dir = sample_dir / "shards"
+        self._ensure(shard_dir)
+
+        # samtools lives next to featureCounts in the env
+        samtools = str(Path(sys.executable).parent/"samtools")
+
+        # default to the chromosomes that actually have mapped reads, idxstats only reads the index
+        if chroms is None:
+            result = subprocess.run([samtools,"idxstats",str(bam_file)],capture_output=True,text=True)
+            chroms = [
+                fields[0] for fields in (line.split("\t") for line in result.stdout.splitlines())
+                if len(fields) >= 3 and fields[0] != "*" and fields[2] != "0"
+            ]
+        if not chroms:
+            raise RuntimeError(f"No mapped chromosomes found in {bam_file}, is it indexed?")
+
+        log_file = sample_dir / "logs" / "featureCounts.log"
+        self._ensure(log_file.parent)
+
+        def count_shard(chrom):
+            # slice the chromosome out of the bam (region fetch through the index) and count it
+            shard = shard_dir / f"{name}_{chrom}.bam"
+            shard_counts = shard_dir / f"{name}_{chrom}_counts.txt"
+            with open(log_file,"ab") as logf:
+                view = subprocess.run([samtools,"view","-b",str(bam_file),chrom,"-o",str(shard)],
+                                      stdout=logf, stderr=subprocess.STDOUT)
+                if view.returncode != 0:
+                    raise RuntimeError(f"samtools view failed for {chrom} on {bam_file}")
+                cmd = [self.env_path, *self._static_args, "-o", str(shard_counts), str(shard)]
+                result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
+            log_subprocess(result,sample_dir,f"featureCounts_{chrom}")
+            # the shard bam is pure scratch
+            shard.unlink(missing_ok=True)
+            if result.returncode != 0 or not shard_counts.exists():
+                raise RuntimeError(f"featureCounts failed for shard {chrom} of {bam_file}")
+            return shard_counts
+
+        # one worker per shard up to the core budget
+        workers = max(1, min(len(chroms), (os.cpu_count() or 1)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            shard_files = list(executor.map(count_shard, chroms))
+
+        # every shard is counted against the full GTF so gene rows line up exactly,
+        # merging is a straight sum of the count arrays (lazy import keeps numpy out
+        # of the wrapper's import cost when sharding is unused)
+        from src.counts import Counts
+        ids = None
+        total = None
+        for shard_counts in shard_files:
+            shard_ids, vals = Counts.parse_count_arrays(shard_counts)
+            if total is None:
+                ids, total = shard_ids, vals
+            else:
+                total += vals
+            shard_counts.unlink(missing_ok=True)
+
+        # write the merged file in the same id/count layout parse_count reads back
         out_file = sample_dir / f"{name}_counts.txt"
+        with open(out_file,"w") as f:
+            f.write(f"Geneid\t{name}\n")
+            f.writelines(f"{g}\t{v}\n" for g,v in zip(ids, total.tolist()))
 
-        # build command
-        cmd = [
-            self.env_path,
-            "-T", str(threads),
-            "-s", str(strand),
-            "-t", str(feature_type),
-            "-g", str(gtf_attr_type),
-            "-a", str(gtf_file),
-            "-o", str(out_file)
-        ]
+        # same cleanup contract as count_features
+        if out_file.exists() and not self.save_files:
+            try:
+                bam_file.unlink()
+                log.debug(f"FeatureCount successful, deleted input bam:\n{bam_file}\n")
+            except Exception as e:
+                log.warning(f"Warning, could not delete file:\n{bam_file}\nError:\n{e}\n")
+
+        return out_file
+
+    def count_features(self, bam_file: Path):
+        """
+        Runs featurecounts to produce count files from bam files
+        Params:
+            bam_file                    path to the bam file to be counted
+        """
+        # sample name
+        name = bam_sample_name(str(bam_file))
+
+        sample_dir = self.sample_dir
 
-        # append optional values
-        if ignoreDup:
-            cmd.append("--ignoreDup")
-        if isPairedEnd:
-            cmd.extend(["-p","--countReadPairs"])
+        # build output file
+        out_file = sample_dir / f"{name}_counts.txt"
 
-        # append the input file
-        cmd.append(str(bam_file))
+        # build command from the static template plus the output and input paths
+        cmd = [self.env_path, *self._static_args, "-o", str(out_file), str(bam_file)]
 
-        # run subprocess
-        result = subprocess.run(cmd,capture_output=True,text=True)
+        # run subprocess, streaming output straight to the log file instead of buffering
+        # it through the driver
+        log_file = sample_dir / "logs" / "featureCounts.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log subprocess
+        # log subprocess (returncode only, the output already lives in featureCounts.log)
         log_subprocess(result,sample_dir,"featureCounts")
-        
+
         # if we are not saving files then delete the input bam
-        if out_file.exists() and not save_files:
+        if out_file.exists() and not self.save_files:
             try:
                 bam_file.unlink()
-                print(f"FeatureCount successful, deleted input bam:\n{bam_file}\n")
+                log.debug(f"FeatureCount successful, deleted input bam:\n{bam_file}\n")
             except Exception as e:
-                print(f"Warning, could not delete file:\n{bam_file}\nError:\n{e}\n")
+                log.warning(f"Warning, could not delete file:\n{bam_file}\nError:\n{e}\n")
         
 
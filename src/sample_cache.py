@@ -0,0 +1,63 @@
+# region Imports
+
+from pathlib import Path
+import hashlib, os, pickle, sys, tempfile
+
+# location of pipeline root dir
+root_dir = Path(__file__).resolve().parent.parent
+# tell python to look here for modules
+sys.path.insert(0, str(root_dir))
+
+from src.utils import generate_paired_samples
+
+# endregion
+
+def paired_samples_cached(in_path: Path, sample1=None, sample2=None):
+    """
+    Cached front end for generate_paired_samples
+    every SLURM array task scans the full input dir at startup, for large runs that is hundreds of identical
+    directory walks, so the pairing result is pickled to the temp dir keyed on the input dir's mtime
+    the key includes the dir mtime so adding/removing fastq files busts the cache automatically
+    Params:
+        in_path                         Path to directory containing fastq files
+        sample1                         Optional, forward read file if running a single pair (passed through)
+        sample2                         Optional, reverse read file if running a single pair (passed through)
+    Returns:
+        paired_samples                  same list of (r1,r2) Path tuples generate_paired_samples returns
+    """
+    in_path = Path(in_path)
+
+    # build a stable key, note python's hash() is salted per process so we digest instead
+    key = f"{in_path}|{os.stat(in_path).st_mtime_ns}|{sample1}|{sample2}"
+    digest = hashlib.sha1(key.encode()).hexdigest()
+
+    # per-uid cache dir with 0700 perms, a world-writable shared temp would let any
+    # local user plant a pickle under a predictable name (unpickling runs their code)
+    # if the path is squatted by another user, skip caching entirely rather than trust it
+    cache_dir = Path(tempfile.gettempdir()) / f"rnaseq_cache_{os.getuid()}"
+    try:
+        cache_dir.mkdir(mode=0o700, exist_ok=True)
+        if cache_dir.stat().st_uid != os.getuid():
+            raise OSError("cache dir owned by another user")
+    except OSError:
+        return generate_paired_samples(in_path, sample1, sample2)
+    cache_file = cache_dir / f"rnaseq_paired_{digest}.pkl"
+
+    # serve from cache if a result for this exact key exists, OSError covers unreadable
+    # files (eg permission problems) as well as plain missing ones
+    try:
+        return pickle.loads(cache_file.read_bytes())
+    except (pickle.UnpicklingError, EOFError, OSError):
+        # missing or corrupt cache, fall through and regenerate
+        pass
+
+    # do the real directory scan and pairing
+    paired_samples = generate_paired_samples(in_path, sample1, sample2)
+
+    # write the cache for the next process, skip quietly if temp is not writable
+    try:
+        cache_file.write_bytes(pickle.dumps(paired_samples, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+
+    return paired_samples
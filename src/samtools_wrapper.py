@@ -1,16 +1,21 @@
 # region Imports
 
 from pathlib import Path
-import sys, subprocess
+import sys, os, subprocess, re, logging, shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
 # tell python to look here for modules
 sys.path.insert(0, str(root_dir))
 
-from src.utils import log_subprocess
+from src.utils import log_subprocess, bam_sample_name, available_memory
 from src.config_loader import ConfigLoader
 
+# per-module logger, a null handler by default so the per-sample messages cost nothing
+# unless the caller opts in with logging.basicConfig
+log = logging.getLogger(__name__)
+
 # endregion
 
 class SamtoolsWrapper:
@@ -37,6 +42,245 @@ class SamtoolsWrapper:
         self.sample_dir = Path(sample_dir)
         self.env_path = str(Path(sys.executable).parent/"samtools")
 
+        # hoist config reads and static dir creation out of the per-sample methods,
+        # none of these change between samples
+        self.project = cfg.get_path("project","name",base_path=self.root)
+        self.ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
+        for dir in [self.project,self.ref_dir,self.sample_dir]:
+            dir.mkdir(parents=True,exist_ok=True)
+        self.threads = cfg.get_threads("samtools")
+        self.sortMemory = cfg.get("tools","samtools","sortMemory")
+        self.minMapQuality = cfg.get("tools","samtools","minMapQuality")
+        self.filter_f = cfg.get("tools","samtools","filter_f")
+        self.filter_F = cfg.get("tools","samtools","filter_F")
+        self.save_files = cfg.get("project","save_files")
+
+        # cap the configured budgets by what this host actually grants, a static config
+        # oversubscribing a shared node causes swap/contention and undersubscribing idles cores
+        try:
+            affinity = len(os.sched_getaffinity(0))
+        except AttributeError:
+            affinity = os.cpu_count() or 1
+        self.threads = min(int(self.threads), affinity)
+
+        # cap per-thread sort memory so threads x buffer stays within available memory,
+        # halved for headroom since sort is not the only thing running
+        unit_scale = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+        mem_str = str(self.sortMemory)
+        unit = mem_str[-1].upper()
+        if unit in unit_scale:
+            cfg_bytes = int(float(mem_str[:-1]) * unit_scale[unit])
+            available = available_memory()
+            if available:
+                per_thread_cap = available // (2 * max(1, self.threads))
+                if per_thread_cap and cfg_bytes > per_thread_cap:
+                    self.sortMemory = f"{max(1, per_thread_cap >> 20)}M"
+
+        # pre-stringify the invariant command fragments once the caps above have settled,
+        # every method splices these into argv lists so str() on the same handful of
+        # values repeats thousands of times across a large batch otherwise
+        self._threads_s = str(self.threads)
+        self._sortMemory_s = str(self.sortMemory)
+        self._minMapQuality_s = str(self.minMapQuality)
+        self._filter_f_s = str(self.filter_f) if self.filter_f else None
+        self._filter_F_s = str(self.filter_F) if self.filter_F else None
+
+        # dirs we have already created this run, saves a stat+mkdir syscall pair per
+        # method call once a dir is known to exist
+        self._ensured_dirs = set()
+
+        # probe the samtools version once, --write-index and ##idx## output naming
+        # need 1.10 or newer
+        self._samtools_version = self._probe_version()
+
+    def _probe_version(self):
+        """
+        Runs samtools --version once and parses the version into a comparable tuple
+        Returns:
+            (major, minor) tuple, or None if the binary/version can not be read
+        """
+        try:
+            result = subprocess.run([self.env_path,"--version"],capture_output=True,text=True)
+            # first line prints like "samtools 1.17"
+            match = re.search(r"samtools (\d+)\.(\d+)", result.stdout)
+            if match:
+                return tuple(int(g) for g in match.groups())
+        except OSError:
+            pass
+        return None
+
+    def _ensure(self, p: Path):
+        """
+        mkdir that only hits the filesystem the first time a path is seen
+        Params:
+            p                               directory path to create if we have not already
+        """
+        if p not in self._ensured_dirs:
+            p.mkdir(parents=True,exist_ok=True)
+            self._ensured_dirs.add(p)
+
+    def _sort_tmp_args(self, file: Path, name: str):
+        """
+        Returns the -T args pointing samtools sort's spill files at the RAM backed tmpfs
+        when /dev/shm exists and has comfortable headroom for this input, spill chunks are
+        written and re-read during the merge phase so keeping them in DRAM removes the
+        disk bound stalls, returns [] when tmpfs is unavailable or too small
+        Params:
+            file                                input file being sorted (sized against free tmpfs space)
+            name                                sample name used to keep spill prefixes unique
+        """
+        shm = Path("/dev/shm")
+        try:
+            if shm.is_dir() and shutil.disk_usage(shm).free > 4 * file.stat().st_size:
+                return ["-T", str(shm / f"rnaseq_sort_{name}")]
+        except OSError:
+            pass
+        return []
+
+    def run_batch(self, files: list):
+        """
+        Runs the fused sort/filter/index pipeline over a list of aligned bams concurrently
+        overlapping the IO bound phases of one sample with the CPU bound phases of another,
+        worker count is sized so both workers x threads stays within the core budget and
+        workers x (sort buffer x threads) stays within half the available memory
+        Params:
+            files                               list of aligned bam files to process
+        Returns:
+            list of (clean_file, idx_file) tuples in input order
+        """
+        # cpu budget, one pipeline per self.threads cores
+        workers = max(1, (os.cpu_count() or 1) // max(1, self.threads))
+
+        # memory budget, each concurrent sort can hold threads x per-thread buffer
+        unit_scale = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+        mem_str = str(self.sortMemory)
+        available = available_memory()
+        if mem_str[-1].upper() in unit_scale and available:
+            per_job = int(float(mem_str[:-1]) * unit_scale[mem_str[-1].upper()]) * max(1, self.threads)
+            workers = max(1, min(workers, available // (2 * per_job)))
+
+        # nothing to gain from a pool with one worker or one file
+        if workers == 1 or len(files) <= 1:
+            return [self.sort_filter_index(f) for f in files]
+
+        # threads are enough, each worker just blocks on external samtools processes
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.sort_filter_index, f) for f in files]
+            # surface any worker exception instead of failing silently
+            return [future.result() for future in futures]
+
+    def sort_filter_index(self, file: Path, output_fmt: str = "bam"):
+        """
+        Fuses sort, filter, and index into a single piped pipeline so the BAM only crosses the disk once
+        the separate sort_file/filter_file/index_file path writes and re-reads a full BAM at every step,
+        for a multi GB alignment that is ~3x the necessary IO
+        filtering runs first so sort only has to handle reads that survive, and sort emits the index
+        in the same pass via --write-index
+        Params:
+            file                                aligned bam file to process
+            output_fmt                          "bam" (default) or "cram", cram writes the archive format
+                                                directly from sort and skips the separate cram_file pass
+                                                (only use cram when no downstream step needs a bam)
+        Returns:
+            (clean_file, idx_file) paths to the sorted+filtered file and its index (in temp dir)
+        """
+        # samtools before 1.10 has neither --write-index nor ##idx## output naming,
+        # fall back to the legacy three-step path (extra disk passes, but correct everywhere)
+        if self._samtools_version is not None and self._samtools_version < (1,10):
+            sorted_file = self.sort_file(file)
+            clean_file = self.filter_file(sorted_file)
+            idx_file = self.index_file(clean_file)
+            return clean_file, idx_file
+
+        # get raw bam QC
+        self.flagstat(file,"raw")
+
+        # get sample name
+        name = bam_sample_name(str(file))
+
+        # get dirs (project/sample dirs are guaranteed by __init__)
+        sample_dir = self.sample_dir
+        temp_dir = self.temp_dir / name
+        self._ensure(temp_dir)
+
+        # build output file and index, cram output is encoded straight out of sort so
+        # the separate bam -> cram re-encode pass (and its full read/write cycle) is skipped
+        if output_fmt == "cram":
+            ref_fasta = self.cfg.get_path("reference","genome_fasta",base_path=self.ref_dir)
+            out_file = temp_dir / f"{name}_Aligned_Sorted_Filtered.cram"
+            idx_file = temp_dir / f"{name}_Aligned_Sorted_Filtered.cram.crai"
+        else:
+            out_file = temp_dir / f"{name}_Aligned_Sorted_Filtered.bam"
+            idx_file = temp_dir / f"{name}_Aligned_Sorted_Filtered.bam.bai"
+
+        # build filter command, output goes to stdout for sort to consume
+        # -u keeps the piped stream uncompressed, bgzf deflate is the dominant CPU cost and
+        # compressing bytes that only live in a pipe for sort to immediately inflate is pure waste,
+        # only the final sort output pays for compression
+        view_cmd = [
+            self.env_path,
+            "view",
+            "-u",
+            "-@", self._threads_s,
+            "-q", self._minMapQuality_s
+        ]
+
+        # append additional filters if specified
+        if self._filter_f_s:
+            view_cmd.extend(["-f",self._filter_f_s])
+        if self._filter_F_s:
+            view_cmd.extend(["-F",self._filter_F_s])
+
+        # append input file
+        view_cmd.append(str(file))
+
+        # build sort command reading from stdin, ##idx## names the index so we get it in the same pass
+        sort_cmd = [
+            self.env_path,
+            "sort",
+            "-@", self._threads_s,
+            "-m", self._sortMemory_s,
+            "--write-index",
+            *self._sort_tmp_args(file, name),
+            "-o", f"{out_file}##idx##{idx_file}",
+            "-"
+        ]
+
+        # cram needs the reference fasta to encode against
+        if output_fmt == "cram":
+            sort_cmd[2:2] = ["-O","cram","--reference",str(ref_fasta)]
+
+        # wire filter stdout straight into sort stdin, binary mode so nothing gets decoded
+        # view's stderr streams to the step log file, holding it in a pipe that is only
+        # read after sort finishes can deadlock the pair when view gets chatty (eg
+        # warning spam on a truncated bam fills the buffer and stalls both processes)
+        log_file = sample_dir / "logs" / "samtools_filter.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            view = subprocess.Popen(view_cmd, stdout=subprocess.PIPE, stderr=logf)
+            sort_result = subprocess.run(sort_cmd, stdin=view.stdout, capture_output=True)
+        # close our copy of the pipe and collect the filter side's exit status
+        view.stdout.close()
+        view_rc = view.wait()
+
+        # log both halves of the pipeline (view's output already lives in the log file)
+        log_subprocess(subprocess.CompletedProcess(view_cmd, view_rc, b"", b""), sample_dir, "samtools_filter")
+        log_subprocess(sort_result, sample_dir, "samtools_sort_index")
+
+        # get filtered QC
+        self.flagstat(out_file,"filtered")
+
+        # if the pipeline was successful then delete the input file
+        if out_file.exists():
+            try:
+                file.unlink()
+                log.debug(f"Samtools sort/filter/index complete, deleted input file:\n{file}\n")
+            except Exception as e:
+                log.warning(f"Warning, could not delete input file:\n{file}\nError:\n{e}\n")
+
+        # return paths to cleaned file and its index
+        return out_file, idx_file
+
     def sort_file(self, file: Path):
         """
         Sorts given BAM file to prepare for indexing, first step of samtools processing
@@ -49,54 +293,50 @@ class SamtoolsWrapper:
         self.flagstat(file,"raw")
 
         # get sample name
-        name = file.stem.split("Aligned")[0]
-
-        # load config
-        cfg = self.cfg
+        name = bam_sample_name(str(file))
 
-        # get dirs
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get dirs (project/sample/ref dirs are guaranteed by __init__)
         sample_dir = self.sample_dir
         temp_dir = self.temp_dir / name
-        ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
-
-        # make sur directories exist
-        for dir in [project,sample_dir,ref_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
+        self._ensure(temp_dir)
 
-        # get config values
-        threads = cfg.get_threads("samtools")
-        sortMemory = cfg.get("tools","samtools","sortMemory")
-        
         # build output file
         out_file = temp_dir / f"{name}_Aligned_Sorted.bam"
 
-        # build command
+        # build command, -l 0 leaves the intermediate uncompressed because filter_file
+        # re-reads and re-compresses it anyway, deflating twice is pure wasted CPU
+        # (only used on the legacy path, the fused pipeline never writes this file at all)
         cmd = [
             self.env_path,
             "sort",
-            "-@", str(threads),
-            "-m", str(sortMemory),
+            "-@", self._threads_s,
+            "-m", self._sortMemory_s,
+            "-l", "0",
+            *self._sort_tmp_args(file, name),
             "-o", str(out_file),
             str(file)
         ]
 
-        # execute command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # execute command, samtools sort progress goes straight to the log file instead of
+        # being buffered through the driver
+        log_file = sample_dir / "logs" / "samtools_sort.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log results
+        # log results (returncode only, the output already lives in the log file)
         log_subprocess(result, sample_dir, "samtools_sort")
 
-        # get sorted QC
-        self.flagstat(out_file,"sorted")
-        
+        # no flagstat here, sorting does not change flags so the sorted stats would be
+        # byte-identical to the raw ones and the scan is a full read of the bam
+
         # if subprocess was successful then delete input file
         if out_file.exists():
             try:
                 file.unlink()
-                print(f"Samtools sort complete, deleted input file:\n{file}\n")
+                log.debug(f"Samtools sort complete, deleted input file:\n{file}\n")
             except Exception as e:
-                print(f"Warning, could not delete input file:\n{file}\nError:\n{e}\n")
+                log.warning(f"Warning, could not delete input file:\n{file}\nError:\n{e}\n")
         
         # return path to sorted file
         return out_file
@@ -108,49 +348,46 @@ class SamtoolsWrapper:
             file                              Path to sorted bam/cram file to be indexed (we also filter before indexing by default but filtering is not required)
         """
         # get file name
-        name = file.stem.split("_Aligned")[0]
+        name = bam_sample_name(str(file))
 
-        # load config
-        cfg = self.cfg
-
-        # get config dirs
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get dirs (guaranteed by __init__)
         sample_dir = self.sample_dir
-        ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
-
-        # make sure directories exist
-        for dir in [project,sample_dir,ref_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
 
         # get values from config
         ext = "bai"
-        threads = cfg.get_threads("samtools")
         if cram:
-            genome = cfg.get_path("reference","genome_fasta",base_path=ref_dir)
             ext = "crai"
-        
-        # out file location
-        out_file = self.temp_dir / name / f"{name}.{ext}"
 
-        # build command
+        # index sits alongside its data file (sample.bam.bai / sample.cram.crai), which is
+        # where every downstream tool looks for it
+        out_file = file.with_name(f"{file.name}.{ext}")
+
+        # skip the rebuild when an up to date index already exists, indexing is a full
+        # decompression pass over the file
+        try:
+            if out_file.stat().st_mtime_ns >= file.stat().st_mtime_ns:
+                return out_file
+        except OSError:
+            pass
+
+        # build command, index path goes as the second positional argument
+        # (-o is only understood by newer samtools and the old call pointed it at a
+        # .bam-named file in the temp dir where nothing would find it)
         cmd = [
             self.env_path,
             "index",
-            "-@", str(threads),
-            "-o", str(out_file),
+            "-@", self._threads_s,
+            str(file),
+            str(out_file)
         ]
 
-        # if we are indexing a cram file then add genome fasta location
-        if cram:
-            cmd.extend(["-T",genome])
+        # run command, streaming output straight to the log file
+        log_file = sample_dir / "logs" / "samtools_index.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # append input file
-        cmd.append(str(file))
-
-        # run command
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        # log results
+        # log results (returncode only)
         log_subprocess(result, sample_dir, "samtools_index")
 
         return out_file
@@ -164,26 +401,12 @@ class SamtoolsWrapper:
             Path to the sorted filtered bam file (in the temp dir, we save later if specified)
         """
         # get sample name
-        name = file.stem.split("_Aligned")[0]
+        name = bam_sample_name(str(file))
 
-        # load config
-        cfg = self.cfg
-
-        # get dirs
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get dirs (project/sample/ref dirs are guaranteed by __init__)
         sample_dir = self.sample_dir
         temp_dir = self.temp_dir / name
-        ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
-
-        # make sure directories exist
-        for dir in [project,sample_dir,temp_dir,ref_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
-
-        # get values from config
-        threads = cfg.get_threads("samtools")
-        minMapQuality = cfg.get("tools","samtools","minMapQuality")
-        filter_f = cfg.get("tools","samtools","filter_f")
-        filter_F = cfg.get("tools", "samtools", "filter_F")
+        self._ensure(temp_dir)
 
         # build output file
         out_file = temp_dir / f"{name}_Aligned_Sorted_Filtered.bam"
@@ -193,24 +416,27 @@ class SamtoolsWrapper:
             self.env_path,
             "view",
             "-b",
-            "-@", str(threads),
-            "-q", str(minMapQuality),
+            "-@", self._threads_s,
+            "-q", self._minMapQuality_s,
             "-o", str(out_file)
         ]
 
         # append additional filters if specified
-        if filter_f:
-            cmd.extend(["-f",str(filter_f)])
-        if filter_F:
-            cmd.extend(["-F",str(filter_F)])
+        if self._filter_f_s:
+            cmd.extend(["-f",self._filter_f_s])
+        if self._filter_F_s:
+            cmd.extend(["-F",self._filter_F_s])
 
         # append input file
         cmd.append(str(file))
         
-        # run subprocess
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # run subprocess, streaming output straight to the log file
+        log_file = sample_dir / "logs" / "samtools_filter.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log subprocess
+        # log subprocess (returncode only)
         log_subprocess(result,sample_dir,"samtools_filter")
 
         # get filtered QC
@@ -220,41 +446,36 @@ class SamtoolsWrapper:
         if out_file.exists():
             try:
                 file.unlink()
-                print(f"Samtools filter complete, deleted input file:\n{file}\n")
+                log.debug(f"Samtools filter complete, deleted input file:\n{file}\n")
             except Exception as e:
-                print(f"Warning, could not delete input file:\n{file}\nError:\n{e}\n")
+                log.warning(f"Warning, could not delete input file:\n{file}\nError:\n{e}\n")
         
         return out_file
 
     def flagstat(self, file: Path, file_status: str):
         """
-        runs flagstat on given BAM file, done before and after sorting, then after filtering
+        runs flagstat on given BAM file, done on the raw input and again after filtering
+        (sorting does not change flags so a sorted flagstat would duplicate the raw one)
         Params:
             file                            path to the file to run flagstat on
-            file_status                     step in the samtools process the flagstat is run on, raw, sorted, or filtered
+            file_status                     step in the samtools process the flagstat is run on, raw or filtered
         """
 
-        # connect to config
-        cfg = self.cfg
-
-        # get dirs
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get dirs (guaranteed by __init__)
         sample_dir = self.sample_dir
 
-        # make sure directories exist
-        for dir in [project,sample_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
-
-        # build command
+        # build command, flagstat is parallelized since samtools 1.10 so give it the
+        # same thread budget as the other steps
         cmd = [
             self.env_path,
             "flagstat",
+            "-@", self._threads_s,
             str(file)
         ]
 
-        # run command
-        result = subprocess.run(cmd,capture_output=True,text=True)
-        
+        # run command, captured in binary mode, log_subprocess decodes when writing the jsonl
+        result = subprocess.run(cmd,capture_output=True)
+
         # log subprocess
         log_subprocess(result,sample_dir,f"flagstat_{file_status}")
 
@@ -265,48 +486,53 @@ class SamtoolsWrapper:
             bam_file                        path to bam file to compress
         """
         # name of the file
-        name = bam_file.stem.split("_Aligned")[0]
-
-        # load config
-        cfg = self.cfg
+        name = bam_sample_name(str(bam_file))
 
-        # get dirs
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get dirs (project/sample dirs are guaranteed by __init__)
         sample_dir = self.sample_dir
         temp_dir = self.temp_dir
-        # make sure dirs exist
-        for dir in [project,sample_dir,temp_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
+        self._ensure(temp_dir)
 
         # get ref .fasta file
-        ref_fasta = cfg.get_path("reference","genome_fasta",base_path=self.root)
+        ref_fasta = self.cfg.get_path("reference","genome_fasta",base_path=self.root)
 
         # build out file
         out_file = temp_dir / f"{name}.cram"
 
-        # build command
+        # build command, -@ parallelizes the bgzf inflate / cram encode which is what
+        # dominates this conversion
         cmd = [
             self.env_path,
             "view",
             "-C",
+            "-@", self._threads_s,
             "-T", str(ref_fasta),
             "-o", str(out_file),
             str(bam_file)
         ]
 
-        # run command
-        result = subprocess.run(cmd,capture_output=True,text=True)
+        # run command, streaming output straight to the log file
+        log_file = sample_dir / "logs" / "cram.log"
+        self._ensure(log_file.parent)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log subprocess
+        # log subprocess (returncode only)
         log_subprocess(result,sample_dir,"cram")
         
-        # if successful then delete input bam file
-        if out_file.exists():
-            try:
-                bam_file.unlink
-                print(f"Cram file generated successfully, deleted input bam:\n{bam_file}\n")
-            except Exception as e:
-                print(f"Warning, could not delete origonal BAM file:\n{bam_file}\nError:\n{e}\n")
+        # if successful then delete input bam file, the old bam_file.unlink (missing parens)
+        # never actually deleted anything so bams piled up on disk across long runs
+        # quickcheck validates the cram's EOF block so a truncated write never costs us the bam
+        if out_file.exists() and out_file.stat().st_size > 0:
+            check = subprocess.run([self.env_path,"quickcheck",str(out_file)])
+            if check.returncode == 0:
+                try:
+                    bam_file.unlink()
+                    log.debug(f"Cram file generated successfully, deleted input bam:\n{bam_file}\n")
+                except Exception as e:
+                    log.warning(f"Warning, could not delete origonal BAM file:\n{bam_file}\nError:\n{e}\n")
+            else:
+                log.warning(f"Warning, cram file failed quickcheck, keeping input bam:\n{bam_file}\n")
 
         # return output cram file
         return out_file
@@ -1,14 +1,14 @@
 # region Imports
 
 from pathlib import Path
-import subprocess, sys
+import os, subprocess, sys
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
 # tell python to look here for modules
 sys.path.insert(0, str(root_dir))
 
-from src.utils import log_subprocess, find_name, get_STAR_suffix
+from src.utils import log_subprocess, find_name, get_STAR_suffix, available_memory
 from src.config_loader import ConfigLoader
 
 # endregion
@@ -62,10 +62,14 @@ class STARIndexBuilder:
             "--sjdbGTFfile", str(gtf_file)
         ]
 
-        # run command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # run command, STAR's progress chatter goes straight to a log file instead of
+        # being buffered through the driver
+        log_file = idx_dir / "logs" / "STAR_index.log"
+        log_file.parent.mkdir(parents=True,exist_ok=True)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log subprocess
+        # log subprocess (returncode only, the output already lives in STAR_index.log)
         log_subprocess(result, idx_dir, "STARIndexBuilder")
 
 class STARAligner:
@@ -87,6 +91,111 @@ class STARAligner:
         self.sample_dir = Path(sample_dir)
         self.env_path = str(Path(sys.executable).parent/"STAR")
 
+        # hoist config reads and static dir creation out of the per-sample path,
+        # none of these change between samples
+        self.project = cfg.get_path("project","name",base_path=self.root)
+        self.ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
+        self.star_index = cfg.get_path("reference","star_index",base_path=self.ref_dir)
+        for dir in [self.project,self.sample_dir,self.ref_dir,self.star_index]:
+            dir.mkdir(parents=True,exist_ok=True)
+        self.threads = cfg.get_threads("STAR")
+        self.suffix = get_STAR_suffix(cfg)
+        self.genomeload = cfg.get("tools","STAR","genomeLoad")
+        self.twopassMode = cfg.get("tools","STAR","twopassMode")
+
+        # remember the configured genomeLoad so the shared memory context can restore it,
+        # and track whether this instance did the preload (a config may legitimately set
+        # LoadAndKeep itself, so the flag decides cleanup, not the string)
+        self._cfg_genomeload = self.genomeload
+        self._shm_loaded = False
+        # a driver that preloaded the index (see __enter__) exports the override through
+        # the env so per-sample aligners in worker processes pick it up too
+        if os.environ.get("RNASEQ_STAR_GENOMELOAD") == "LoadAndKeep" and str(self.twopassMode) != "Basic":
+            self.genomeload = "LoadAndKeep"
+
+        # static part of the STAR command, identical for every sample so built once,
+        # align() only splices in the per-sample read/output paths
+        outSAMtype = str(cfg.get("tools","STAR","outSAMtype")).split()
+        self._static_args = [
+            "--runThreadN", str(self.threads),
+            "--genomeDir", str(self.star_index),
+            "--readFilesCommand", str(cfg.get("tools","STAR","file_type")),
+            "--outSAMtype", *outSAMtype,
+            "--outFilterMultimapNmax", str(cfg.get("tools","STAR","outFilterMultimapNmax")),
+            "--twopassMode", str(self.twopassMode),
+            "--sjdbOverhang", str(cfg.get("tools","STAR","sjdbOverhang")),
+            "--alignIntronMax", str(cfg.get("tools","STAR","alignIntronMax"))
+        ]
+        outReadsUnmapped = cfg.get("tools","STAR","outReadsUnmapped")
+        if outReadsUnmapped == "Within" or outReadsUnmapped == "Fastx":
+            self._static_args.extend(["--outReadsUnmapped", outReadsUnmapped])
+        outFilterMismatchNoverLmax = cfg.get("tools","STAR","outFilterMismatchNoverLmax")
+        if outFilterMismatchNoverLmax:
+            self._static_args.extend(["--outFilterMismatchNoverLmax", str(outFilterMismatchNoverLmax)])
+
+    def _bam_sort_ram(self):
+        """
+        Returns the byte budget passed to --limitBAMsortRAM when aligning against a
+        shared memory index, STAR cannot size the sort from the genome in that mode
+        and hard-exits on its limitBAMsortRAM=0 default
+        an eighth of available memory with a 1 GB floor leaves room for the index
+        itself and for concurrently aligning samples
+        """
+        available = available_memory()
+        if available:
+            return max(1 << 30, available // 8)
+        # no readable limit, fall back to a fixed budget rather than crashing STAR
+        return 8 << 30
+
+    def __enter__(self):
+        """
+        Preloads the genome index into shared memory so every align() inside the context
+        reuses the one mmap'd copy instead of re-reading the multi GB index per sample
+        STAR's shared memory mode is incompatible with --twopassMode Basic, in that case
+        (or if the preload fails) alignments simply fall back to the configured genomeLoad
+        """
+        if str(self.twopassMode) == "Basic":
+            return self
+
+        # keep STAR's preload chatter out of the sample dirs
+        load_dir = self.temp_dir / "STAR_genomeLoad"
+        load_dir.mkdir(parents=True,exist_ok=True)
+        cmd = [
+            self.env_path,
+            "--genomeLoad", "LoadAndExit",
+            "--genomeDir", str(self.star_index),
+            "--outFileNamePrefix", f"{load_dir}/"
+        ]
+        result = subprocess.run(cmd, capture_output=True)
+
+        # only switch align() over to the shared copy when the load actually worked,
+        # the env override reaches per-sample aligners built inside worker processes
+        if result.returncode == 0:
+            self._shm_loaded = True
+            self.genomeload = "LoadAndKeep"
+            os.environ["RNASEQ_STAR_GENOMELOAD"] = "LoadAndKeep"
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """
+        Drops the shared memory index once the batch is done, restoring the configured genomeLoad
+        only the instance that actually did the preload cleans up, so a config that sets
+        genomeLoad LoadAndKeep itself is left alone
+        """
+        if self._shm_loaded:
+            load_dir = self.temp_dir / "STAR_genomeLoad"
+            cmd = [
+                self.env_path,
+                "--genomeLoad", "Remove",
+                "--genomeDir", str(self.star_index),
+                "--outFileNamePrefix", f"{load_dir}/"
+            ]
+            subprocess.run(cmd, capture_output=True)
+            self.genomeload = self._cfg_genomeload
+            self._shm_loaded = False
+            os.environ.pop("RNASEQ_STAR_GENOMELOAD", None)
+        return False
+
     def align(self, r1: Path, r2: Path, cleanup=False):
         """
         Preforms alignment of file r1 and r2 to the Star index
@@ -101,74 +210,42 @@ class STARAligner:
         # get sample name
         name = find_name(r1,r2)
 
-        # connect to config
-        cfg = self.cfg
-
-        # get directories
-        project = cfg.get_path("project","name",base_path=self.root)
+        # get per-sample dirs (project/sample/ref/index dirs are guaranteed by __init__)
         sample_dir = self.sample_dir
-        ref_dir = cfg.get_path("reference","ref_dir",base_path=self.root)
-        star_index = cfg.get_path("reference","star_index",base_path=ref_dir)
         temp_dir = self.temp_dir / name
-
-        # make sure directories exist
-        for dir in [project,sample_dir,ref_dir,star_index,temp_dir]:
-            dir.mkdir(parents=True,exist_ok=True)
-
-        # get threads
-        threads = cfg.get_threads("STAR")
-
-        # get additional parameters
-        readFilesCommand = cfg.get("tools","STAR","file_type")
-        outSAMtype_raw = cfg.get("tools","STAR","outSAMtype")
-        outSAMtype = outSAMtype_raw.split()
-        genomeload = cfg.get("tools","STAR","genomeLoad")
-        outFilterMultimapNMax = cfg.get("tools","STAR","outFilterMultimapNmax")
-        twopassMode = cfg.get("tools","STAR","twopassMode")
-        sjdbOverhang = cfg.get("tools","STAR","sjdbOverhang")
-        alignIntronMax = cfg.get("tools","STAR","alignIntronMax")
-        outReadsUnmapped = cfg.get("tools","STAR","outReadsUnmapped")
-        outFilterMismatchNoverLmax = cfg.get("tools","STAR","outFilterMismatchNoverLmax")
+        temp_dir.mkdir(parents=True,exist_ok=True)
 
         # specify output file
         out_file = temp_dir / f"{name}"
 
-        # build command
+        # build command from the per-sample IO paths plus the static template from __init__
         cmd = [
             self.env_path,
-            "--runThreadN", str(threads),
-            "--genomeDir", str(star_index),
             "--readFilesIn", str(r1), str(r2),
-            "--readFilesCommand", str(readFilesCommand),
             "--outFileNamePrefix", str(out_file),
-            "--outSAMtype", *outSAMtype,
-            "--genomeLoad", str(genomeload),
-            "--outFilterMultimapNmax", str(outFilterMultimapNMax),
-            "--twopassMode", str(twopassMode),
-            "--sjdbOverhang", str(sjdbOverhang),
-            "--alignIntronMax", str(alignIntronMax),
-            "--outTmpDir", str(temp_dir / "STAR")
+            "--outTmpDir", str(temp_dir / "STAR"),
+            "--genomeLoad", str(self.genomeload),
+            *self._static_args
         ]
 
-        # add outreadsunmapped if specified
-        if outReadsUnmapped == "Within" or outReadsUnmapped == "Fastx":
-            cmd.extend(["--outReadsUnmapped", outReadsUnmapped])
+        # STAR refuses LoadAndKeep with its limitBAMsortRAM=0 default when writing a
+        # coordinate sorted bam (it can no longer size the sort from the genome), so
+        # the shared memory path passes an explicit budget
+        if self.genomeload == "LoadAndKeep" and "sortedByCoord" in self.suffix:
+            cmd.extend(["--limitBAMsortRAM", str(self._bam_sort_ram())])
 
-        # add outFilterMismatchNoverLmax if specified
-        if outFilterMismatchNoverLmax:
-            cmd.extend(["--outFilterMismatchNoverLmax",outFilterMismatchNoverLmax])
-            
-        # run command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # run command, STAR emits substantial progress logging so stream it straight
+        # to a log file instead of buffering it through the driver
+        log_file = sample_dir / "logs" / "STAR.log"
+        log_file.parent.mkdir(parents=True,exist_ok=True)
+        with open(log_file,"ab") as logf:
+            result = subprocess.run(cmd, stdout=logf, stderr=subprocess.STDOUT)
 
-        # log subprocess
+        # log subprocess (returncode only, the output already lives in STAR.log)
         log_subprocess(result, sample_dir, "STARAligner")
 
-        # get STAR suffix
-        suffix = get_STAR_suffix(cfg)
-
-        # build full path to output file with STAR suffixes attached
-        output_full = out_file.with_name(out_file.name + suffix)
+        # build full path to output file with STAR suffixes attached (suffix hoisted to __init__)
+        output_full = out_file.with_name(out_file.name + self.suffix)
         
         # delete input trimmed files if successful
         if output_full.exists() and cleanup:
@@ -2,7 +2,7 @@
 
 from pathlib import Path
 from datetime import datetime
-import json, os, sys, subprocess
+import atexit, json, os, re, sys, subprocess, shutil, functools
 
 # location of pipeline root dir
 root_dir = Path(__file__).resolve().parent.parent
@@ -11,8 +11,55 @@ sys.path.insert(0, str(root_dir))
 
 from src.config_loader import ConfigLoader
 
+# matches forward read fastq filenames (same set as the old *_R1*.fastq* glob)
+# compiled once at import so directory filtering skips the per-entry fnmatch machinery
+R1_RE = re.compile(r"_R1.*\.fastq(?:\.gz)?$")
+
 # endregion
 
+# one appending fd per subprocess log file, opened lazily and reused so each log
+# entry costs a single write instead of an open/write/close triple, raw O_APPEND
+# writes hit the kernel immediately so there is nothing to flush
+# bounded LRU: every sample dir has its own jsonl, so an unbounded cache in a long
+# local run would pin one fd per processed sample until the process hits EMFILE
+_LOG_FDS = {}
+_LOG_FDS_MAX = 32
+
+def _log_fd(path_str: str):
+    """
+    returns the cached O_APPEND fd for the given log file, opening it on first use
+    the least recently used fd is closed and evicted once the cache is full
+    Params:
+        path_str                    string path to the log file (string so it keys the dict cheaply)
+    """
+    fd = _LOG_FDS.pop(path_str, None)
+    if fd is None:
+        # evict oldest first, closing is safe at any point since appends hold no
+        # userspace buffer and a later call simply reopens the file
+        while len(_LOG_FDS) >= _LOG_FDS_MAX:
+            old_path = next(iter(_LOG_FDS))
+            old_fd = _LOG_FDS.pop(old_path)
+            try:
+                os.close(old_fd)
+            except OSError:
+                pass
+        fd = os.open(path_str, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    # reinsert at the back so dict insertion order tracks recency
+    _LOG_FDS[path_str] = fd
+    return fd
+
+@atexit.register
+def _close_log_fds():
+    """
+    closes the cached log fds at interpreter exit
+    """
+    for fd in _LOG_FDS.values():
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _LOG_FDS.clear()
+
 def log_subprocess(result: subprocess.CompletedProcess, sample_dir: Path, step: str):
     """
     Collects logs produced by python subprocess and puts them in a text file for easy viewing
@@ -32,34 +79,52 @@ def log_subprocess(result: subprocess.CompletedProcess, sample_dir: Path, step:
     # path to log file
     log_file = log_dir / "subprocess_log.jsonl"
 
-    # dict of values to store
+    # decode only what actually gets logged, wrappers capture in binary mode so the
+    # subprocess itself never pays a text-mode decode of its full output
+    stdout = result.stdout
+    stderr = result.stderr
+    if isinstance(stdout, bytes):
+        stdout = stdout.decode(errors="replace")
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors="replace")
+
+    # dict of values to store, stdout/stderr are None when the subprocess streamed straight to a file
     data = {
         "step": step,
         "log_ts": timestamp,
-        "stdout": result.stdout,
-        "stderr": result.stderr
+        "returncode": result.returncode,
+        "stdout": stdout,
+        "stderr": stderr
     }
 
-    with open(log_file, "a") as f:
-        f.write(json.dumps(data) + "\n")
+    # serialize the whole record once and append it with a single O_APPEND write,
+    # one syscall per entry and the json line stays atomic even when several wrapper
+    # threads log to the same file concurrently
+    payload = (json.dumps(data) + "\n").encode()
+    os.write(_log_fd(str(log_file)), payload)
 
-def find_name(r1: Path, r2: Path):
+@functools.lru_cache(maxsize=4096)
+def bam_sample_name(path_str: str):
     """
-    Generates sring names for two given input files under standard naming conventions for this pipeline
+    Extracts the sample name from an aligned bam/cram file path by dropping the _Aligned suffix
+    memoized because sort, filter, index and count all recompute the same name for one sample
     Params:
-        r1                          Path object pointing to the location of the forward read file including suffix _R1 before file extensions
-        r2                          Same as r1 but for the reverse read file
+        path_str                    string path to the aligned file (string so the cache key is hashable and cheap)
     Returns:
-        name                        Name of the sample
+        name of the sample
     """
+    # partition does a single C-level scan and avoids split's throwaway list
+    return Path(path_str).stem.partition("_Aligned")[0]
 
-    # make sure R1 and R2 are paths
-    r1 = Path(r1)
-    r2 = Path(r2)
-
-    # get shared smaple name
-    name1 = r1.name.split("_R1")[0]
-    name2 = r2.name.split("_R2")[0]
+@functools.lru_cache(maxsize=1024)
+def _find_name(r1_name: str, r2_name: str):
+    """
+    cached core of find_name keyed on the two filename strings, trim/align/count all
+    re-derive the same name for one pair so later calls are a dict hit
+    """
+    # get shared smaple name, partition stops at the first match and skips split's list
+    name1 = r1_name.partition("_R1")[0]
+    name2 = r2_name.partition("_R2")[0]
 
     # if the user followed naming conventions in README.txt then get the name of the sample
     if name1 == name2:
@@ -70,6 +135,18 @@ def find_name(r1: Path, r2: Path):
 
     return name
 
+def find_name(r1: Path, r2: Path):
+    """
+    Generates sring names for two given input files under standard naming conventions for this pipeline
+    Params:
+        r1                          Path object pointing to the location of the forward read file including suffix _R1 before file extensions
+        r2                          Same as r1 but for the reverse read file
+    Returns:
+        name                        Name of the sample
+    """
+    # only the filenames matter for the derivation, so they key the cache
+    return _find_name(Path(r1).name, Path(r2).name)
+
 def remove_file_extensions(file: Path):
     """
     stems a path object until there are no more file extensiosn present
@@ -78,14 +155,9 @@ def remove_file_extensions(file: Path):
     Returns:
         string file name without extensions
     """
-    # ensure file is a Path object
-    file = Path(file)
-
-    # remove suffix while one exists
-    while file.suffix:
-        file = file.with_suffix("")
-
-    return file.name
+    # everything from the first '.' on is extensions (check_name enforces no stray
+    # dots in sample names), so one partition replaces the loop of Path rebuilds
+    return Path(file).name.partition(".")[0]
 
 def check_name(file: Path):
     """
@@ -99,11 +171,13 @@ def check_name(file: Path):
     # get the file's name
     name = file.name
 
-    # get the portion before the extensions
-    if "_R1" in name:
-        name = name.split("_R1")[0]
-    if "_R2" in name:
-        name = name.split("_R2")[0]
+    # locate the earliest read marker with two finds instead of paired in+split
+    # passes, only the prefix before it needs the dot check
+    i1 = name.find("_R1")
+    i2 = name.find("_R2")
+    marks = [i for i in (i1,i2) if i != -1]
+    cut = min(marks) if marks else len(name)
+    name = name[:cut]
 
     # check for incorrect '.' placement
     if "." in name:
@@ -151,19 +225,24 @@ def generate_paired_samples(indir: Path, sample1=None, sample2=None):
 
     # if no specific samples are given
     else:
-        # grab all r1 files
-        r1_files = sorted(in_path.glob("*_R1*.fastq*"))
+        # one scandir pass builds an in-memory set of filenames, pairing then happens
+        # against the set so each R2 lookup is a dict probe instead of another stat,
+        # which matters on NFS/Lustre dirs holding large cohorts
+        with os.scandir(in_path) as it:
+            entries = {e.name for e in it if e.is_file(follow_symlinks=False)}
+        # sort the plain name strings, cheaper than sorting Path objects
+        r1_names = sorted(name for name in entries if R1_RE.search(name))
         # raise error if R1 files do not exist
-        if not r1_files:
+        if not r1_names:
             raise FileNotFoundError(f"no R1 files found in {in_path}")
-        # find the partner of each R1 file and append
-        for r1 in r1_files:
-            r2 = in_path / r1.name.replace("_R1","_R2")
+        # find the partner of each R1 file and append, Paths are only built for output
+        for r1_name in r1_names:
+            r2_name = r1_name.replace("_R1","_R2")
             # check to make sure R2 exists
-            if not r2.exists():
-                raise FileNotFoundError(f"Missing R2 file for sample {r1.name}")
+            if r2_name not in entries:
+                raise FileNotFoundError(f"Missing R2 file for sample {r1_name}")
             # append to output list
-            paired_samples.append((r1,r2))
+            paired_samples.append((in_path / r1_name, in_path / r2_name))
 
     return paired_samples
 
@@ -175,16 +254,15 @@ def get_max_threads(cfg: ConfigLoader):
     Returns:
         max_threads                 maximum number of threads needed for the job
     """
-    # get max threads needed to pass on to the sbatch command
-    tools_dir = cfg.get("tools")
-    tools = tools_dir.keys()
+    # if launcher already computed this and exported it through sbatch then use that
+    env_threads = os.environ.get("RNASEQ_MAX_THREADS")
+    if env_threads:
+        return int(env_threads)
 
-    # find max threads
-    max_threads = 0
-    for key in tools:
-        threads = cfg.get("tools",str(key),"threads")
-        if threads > max_threads:
-            max_threads = threads
+    # fetch the tools table once and walk it locally instead of re-traversing
+    # the config tree with a cfg.get per tool
+    tools = cfg.get("tools")
+    max_threads = max(int(tool.get("threads",0)) for tool in tools.values())
 
     return max_threads
 
@@ -197,32 +275,76 @@ def get_total_memory(cfg: ConfigLoader, max_threads: str):
     Returns:
         total_mem                   total memory needed for the job based on samtools sort mem specified
     """
-    # get sort memory needed for samtools
-    samtools_sort_mem = cfg.get("tools","samtools","sortMemory")
+    # if launcher already computed this and exported it through sbatch then use that
+    env_mem = os.environ.get("RNASEQ_TOTAL_MEM")
+    if env_mem:
+        return env_mem
+
+    # sortMemory was parsed and validated once at config load, whole-unit values stay
+    # ints there so this is plain integer arithmetic in the common case
+    mem_val, unit = cfg.sort_memory
+    total_mem = f"{int(mem_val * int(max_threads))}{unit}"
 
-    # split value into number and units
-    num_part = samtools_sort_mem[:-1]
-    unit = samtools_sort_mem[-1].upper()
+    return total_mem
 
-    # check unit value
-    if unit not in ("G","M"):
-        raise ValueError(f"Unknown memory unit: {unit} must be G (gigabytes) or M (megabytes)")
-    # convert value to float
+def available_memory():
+    """
+    Returns the memory limit in bytes this process actually runs under
+    checks the cgroup limit first (what SLURM/containers enforce), falls back to
+    physical memory, returns None if neither can be read
+    """
+    # cgroup v2 then v1, "max" means unlimited
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            raw = Path(limit_file).read_text().strip()
+            if raw != "max":
+                return int(raw)
+        except (OSError, ValueError):
+            continue
+    # physical memory as last resort
     try:
-        mem_val = float(num_part)
-    except ValueError:
-        raise ValueError(f"could not convert memory value {mem_val} to number")
-    # calculate total memory value needed
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return None
 
-    mem_val *= int(max_threads)
-    # convert to string total memory
-    total_mem = f"{int(mem_val)}{unit}"
+def fast_move(src: Path, dst: Path):
+    """
+    Moves a file to a new location without rewriting its bytes when possible
+    BAM/CRAM files can be many GB so a plain copy+delete wastes a full read and write of the file
+    Params:
+        src                         Path to the file to move
+        dst                         Path to move the file to
+    Returns:
+        dst as a Path object
+    """
+    src = Path(src)
+    dst = Path(dst)
 
-    return total_mem
+    # rename is a metadata only operation when src and dst share a filesystem
+    try:
+        os.replace(src, dst)
+        return dst
+    except OSError:
+        pass
 
+    # hard link + unlink is also metadata only where the filesystem allows it
+    try:
+        os.link(src, dst)
+        src.unlink()
+        return dst
+    except OSError:
+        pass
+
+    # src and dst are on different filesystems so we have to actually copy the bytes
+    shutil.copy2(src, dst)
+    src.unlink()
+    return dst
+
+@functools.lru_cache(maxsize=None)
 def get_scratch(root: Path):
     """
     gets scratch/temp dir from HPC or as specified by the CLI command if running locally
+    memoized since TMPDIR/PFSDIR are process-constant, repeat calls skip the env lookups
     Params:
         root                        Path to root dir of project to put temp in if not running on cluster with Scratch
     """
@@ -240,6 +362,17 @@ def get_scratch(root: Path):
     # if neither are available then make temp dir in root
     return Path(root) / "temp"
 
+# the legal outSAMtype values are a tiny fixed set, so the branch chain collapses
+# into a table built once at import and get_STAR_suffix becomes a dict probe
+_STAR_SUFFIX = {
+    ("BAM", None): "Aligned.out.bam",
+    ("SAM", None): "Aligned.out.sam",
+    ("BAM", "SortedByCoordinate"): "Aligned.sortedByCoord.out.bam",
+    ("SAM", "SortedByCoordinate"): "Aligned.sortedByCoord.out.sam",
+    ("BAM", "SortedByName"): "Aligned.sortedByName.out.bam",
+    ("SAM", "SortedByName"): "Aligned.sortedByName.out.sam",
+}
+
 def get_STAR_suffix(cfg: ConfigLoader):
     """
     Gets the suffxi that STAR will add to the bam file generated by Star_wrapper STARAligner.align()
@@ -251,35 +384,12 @@ def get_STAR_suffix(cfg: ConfigLoader):
     # get the sample type configuration
     SAMtype = cfg.get("tools","STAR","outSAMtype")
 
-    # split string at the space
+    # split string at the space and look the pair up in the table
     parts = str(SAMtype).split()
-    file_type = parts[0]
-    sorting = parts[1] if len(parts)>1 else None
-
-    # find file type for suffix
-    if file_type == "BAM":
-        suffix_type = "bam"
-    elif file_type == "SAM":
-        suffix_type = "sam"
-    else:
+    key = (parts[0], parts[1] if len(parts)>1 else None)
+    try:
+        return _STAR_SUFFIX[key]
+    except KeyError:
         raise ValueError(f"Unsupported STAR outSAMtype {SAMtype}")
-    
-    # check if sorting was specified
-    if not sorting:
-        full_suffix = f"Aligned.out.{suffix_type}"
-
-    # if it was then add requried parts to STAR suffix
-    else:
-        if sorting not in ["SortedByCoordinate","SortedByName"]:
-            raise ValueError(f"Unsupported STAR outSAMtype {SAMtype}")
-
-        elif sorting == "SortedByCoordinate":
-            suffix_sort = "sortedByCoord"
-        else:
-            suffix_sort = "sortedByName"
-
-        full_suffix = f"Aligned.{suffix_sort}.out.{suffix_type}"
-
-    return full_suffix
 
     
\ No newline at end of file